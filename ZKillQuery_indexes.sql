@@ -0,0 +1,23 @@
+--
+-- Indexes, created by zkill_db_init after the reference data is loaded
+--
+-- Text encoding used: UTF-8
+--
+BEGIN TRANSACTION;
+
+-- Index: time_based
+CREATE INDEX IF NOT EXISTS time_based ON killmails (
+    time ASC,
+    killmail_id ASC
+);
+
+CREATE INDEX IF NOT EXISTS idx_invGroups_categoryID ON invGroups (categoryID);
+CREATE INDEX IF NOT EXISTS idx_invGroups_groupName ON invGroups (groupName);
+
+CREATE INDEX IF NOT EXISTS idx_invCategories_categoryName ON invCategories (categoryName);
+CREATE INDEX IF NOT EXISTS idx_invCategories_iconID ON invCategories (iconID);
+
+COMMIT TRANSACTION;
+
+-- Planner statistics for the freshly loaded tables
+ANALYZE;
@@ -107,12 +107,6 @@ CREATE TABLE IF NOT EXISTS solar_systems (
 );
 
 
--- Index: time_based
-CREATE INDEX IF NOT EXISTS time_based ON killmails (
-    time ASC,
-    killmail_id ASC
-);
-
 CREATE TABLE invGroups (
     groupID INTEGER PRIMARY KEY,
     categoryID INTEGER,
@@ -124,8 +118,6 @@ CREATE TABLE invGroups (
     fittableNonSingleton INTEGER,
     published INTEGER
 );
-CREATE INDEX idx_invGroups_categoryID ON invGroups (categoryID);
-CREATE INDEX idx_invGroups_groupName ON invGroups (groupName);
 
 CREATE TABLE invCategories (
     categoryID INTEGER PRIMARY KEY,
@@ -133,8 +125,13 @@ CREATE TABLE invCategories (
     iconID TEXT,
     published INTEGER
 );
-CREATE INDEX idx_invCategories_categoryName ON invCategories (categoryName);
-CREATE INDEX idx_invCategories_iconID ON invCategories (iconID);
+
+-- Table: reference_files, checksum of each reference CSV last loaded
+CREATE TABLE IF NOT EXISTS reference_files (
+    fname     TEXT PRIMARY KEY,
+    sha256    TEXT NOT NULL,
+    loaded_at TEXT
+);
 
 COMMIT TRANSACTION;
 PRAGMA foreign_keys = on;
@@ -0,0 +1,168 @@
+# esi_client.py
+
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+# HTTP statuses that will never succeed on retry (bad id or hash)
+PERMANENT_STATUSES = {400, 403, 404, 422}
+
+
+def is_permanent_error(e: Exception) -> bool:
+    """True if the failed ESI request should not be retried."""
+    response = getattr(e, "response", None)
+    return response is not None and response.status_code in PERMANENT_STATUSES
+
+
+class EsiScheduler:
+    """
+    Paces ESI requests so the IP stays inside ESI's error limit.
+
+    Shared by every fetch thread.  It reads the X-ESI-Error-Limit-Remain
+    and X-ESI-Error-Limit-Reset headers of each response, pauses all
+    requests until the window resets once the remaining error budget
+    drops to error_limit_floor, honours 420/429 responses, and backs off
+    exponentially (with jitter) while requests keep failing.
+    """
+
+    def __init__(self, min_interval: float = 0.0, error_limit_floor: int = 20,
+                 base_backoff: float = 1.0, max_backoff: float = 300.0, logger=None):
+        self.min_interval = min_interval
+        self.error_limit_floor = error_limit_floor
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.next_request = 0.0       # monotonic time the next request may start
+        self.paused_until = 0.0       # monotonic time a pause for the error limit ends
+        self.consecutive_failures = 0
+        self.error_limit_remain = None
+
+    def wait(self):
+        """Block until this thread may send its next request."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                start = max(self.next_request, self.paused_until)
+                if start <= now:
+                    self.next_request = now + self.min_interval
+                    return
+            time.sleep(min(start - now, 1.0))
+
+    def pause(self, seconds: float, reason: str):
+        with self.lock:
+            until = time.monotonic() + seconds
+            if until > self.paused_until:
+                self.paused_until = until
+                if self.logger:
+                    self.logger.info(f"ESI paused for {seconds:.1f}s: {reason}")
+
+    def record_response(self, response):
+        """Update pacing from the headers and status of an ESI response."""
+        headers = response.headers
+        remain = headers.get("X-ESI-Error-Limit-Remain")
+        reset = headers.get("X-ESI-Error-Limit-Reset")
+
+        if remain is not None:
+            self.error_limit_remain = int(remain)
+            if int(remain) <= self.error_limit_floor:
+                self.pause(float(reset or 60) + 1, f"error limit remain {remain}")
+
+        if response.status_code in (420, 429):
+            retry_after = headers.get("Retry-After") or reset or 60
+            self.pause(float(retry_after) + 1, f"HTTP {response.status_code}")
+
+        if response.status_code < 400:
+            with self.lock:
+                self.consecutive_failures = 0
+
+    def record_failure(self):
+        """Back off exponentially with jitter after a failed request."""
+        with self.lock:
+            self.consecutive_failures += 1
+            failures = self.consecutive_failures
+        delay = min(self.max_backoff, self.base_backoff * (2 ** (failures - 1)))
+        self.pause(delay * random.uniform(0.5, 1.0), f"{failures} consecutive failures")
+
+
+class EsiClient:
+    """
+    Fetches killmails from ESI concurrently.
+
+    All requests share one requests.Session, so connections to
+    esi.evetech.net are kept alive and reused instead of opening a new
+    TLS connection per killmail.  At most `concurrency` requests are in
+    flight at once, paced by an EsiScheduler.  With a KillmailCache,
+    killmails already fetched once are served from disk.
+    """
+
+    KILLMAIL_URL = "https://esi.evetech.net/latest/killmails/{zkillID}/{hash}/"
+
+    def __init__(self, concurrency: int = 8, timeout: float = 30, logger=None,
+                 scheduler: EsiScheduler | None = None, cache=None):
+        self.concurrency = max(1, int(concurrency))
+        self.timeout = timeout
+        self.logger = logger
+        self.scheduler = scheduler or EsiScheduler(logger=logger)
+        self.cache = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="esi")
+
+    def fetch_killmail(self, killID, kill_hash) -> dict:
+        """Fetch one killmail, raises requests.exceptions.RequestException on failure."""
+        if self.cache is not None:
+            try:
+                killmail = self.cache.get(killID, kill_hash)
+            except Exception as e:  # the cache is an optimization, never fail a kill over it
+                killmail = None
+                if self.logger:
+                    self.logger.info(f"Killmail cache read failed for {killID}: {e}")
+            if killmail is not None:
+                return killmail
+
+        url = self.KILLMAIL_URL.format(zkillID=killID, hash=kill_hash)
+        if self.logger:
+            self.logger.info(f"Killmail info for url {killID} {kill_hash} {url}")
+
+        self.scheduler.wait()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self.scheduler.record_failure()
+            raise
+
+        self.scheduler.record_response(response)
+        if response.status_code >= 400 and response.status_code not in PERMANENT_STATUSES:
+            self.scheduler.record_failure()
+        response.raise_for_status()
+        killmail = response.json()
+
+        if self.cache is not None:
+            try:
+                self.cache.put(killID, kill_hash, killmail)
+            except Exception as e:
+                if self.logger:
+                    self.logger.info(f"Killmail cache write failed for {killID}: {e}")
+        return killmail
+
+    def submit(self, killID, kill_hash) -> Future:
+        """Queue a fetch on the worker pool, the Future resolves to the killmail dict."""
+        return self.executor.submit(self.fetch_killmail, killID, kill_hash)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# kill_facts.py
+
+import sqlite3
+
+from utils import setup_logger, get_data_dir, load_config, create_database_connection, run_with_lock_retry, bump_data_generation
+
+# One denormalized kill_facts row per recorded killmail, written by the
+# consumer next to the normalized tables, so dashboard queries filter on
+# group, region or security band without joining five tables.
+
+SECURITY_NULL = 0  # nullsec and wormhole space
+SECURITY_LOW = 1
+SECURITY_HIGH = 2
+
+KILL_FACT_COLUMNS = ("killmail_id", "time_epoch", "solarSystemID", "regionID", "security_band",
+                     "ship_type_id", "groupID", "categoryID", "item_count", "total_value")
+
+INSERT_KILL_FACT = (f"INSERT OR IGNORE INTO kill_facts ({', '.join(KILL_FACT_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(KILL_FACT_COLUMNS))})")
+
+
+def security_band(security) -> int:
+    """SECURITY_HIGH, SECURITY_LOW or SECURITY_NULL, as the game rounds the security status."""
+    if security is None or security != security:  # NULL or NaN
+        return SECURITY_NULL
+    if security >= 0.45:
+        return SECURITY_HIGH
+    if security > 0.0:
+        return SECURITY_LOW
+    return SECURITY_NULL
+
+
+def kill_fact_row(reference, killmail_id, time_epoch, solar_system_id, ship_type_id,
+                  item_count, total_value=None) -> tuple | None:
+    """The kill_facts row of one killmail, None when the system or ship type is unknown."""
+    system = reference.system(solar_system_id)
+    ship_type = reference.item_type(ship_type_id)
+    if system is None or ship_type is None:
+        return None
+    group = reference.group(ship_type.group_id)
+    return (killmail_id, time_epoch, solar_system_id, system.region_id, security_band(system.security),
+            ship_type_id, ship_type.group_id, group.category_id if group else None, item_count, total_value)
+
+
+def insert_kill_facts(conn: sqlite3.Connection, rows) -> int:
+    """
+    Insert kill_facts rows with one executemany.
+
+    Does not commit, the caller owns the transaction.
+    """
+    return conn.executemany(INSERT_KILL_FACT, rows).rowcount
+
+
+def backfill_kill_facts(conn: sqlite3.Connection, reference, logger, config=None, batch_size: int = 10000) -> int:
+    """
+    Write the kill_facts rows of recorded killmails that have none, one
+    transaction per batch_size killmails, so consumers keep writing
+    while it runs and an interrupted backfill picks up where it stopped.
+
+    Returns the number of rows written.
+    """
+    last_id = 0
+    written = 0
+
+    def write(rows):
+        count = insert_kill_facts(conn, rows)
+        bump_data_generation(conn)
+        conn.commit()
+        return count
+
+    while True:
+        killmails = conn.execute("""
+            SELECT km.killmail_id, km.time_epoch, km.solarSystemID, km.ship_type_id,
+                   (SELECT COALESCE(SUM(di.quantity), 0) FROM droppedItems di WHERE di.killmail_id = km.killmail_id)
+            FROM killmails km
+            WHERE km.killmail_id > ?
+              AND NOT EXISTS (SELECT 1 FROM kill_facts f WHERE f.killmail_id = km.killmail_id)
+            ORDER BY km.killmail_id
+            LIMIT ?
+        """, (last_id, batch_size)).fetchall()
+        if not killmails:
+            break
+        last_id = killmails[-1][0]
+
+        rows = [row for row in (kill_fact_row(reference, *killmail) for killmail in killmails) if row]
+        written += run_with_lock_retry(write, rows, config=config, logger=logger)
+        logger.info(f"Backfilled kill_facts up to killmail {last_id}, {written} rows so far")
+
+    return written
+
+
+# ==============================================
+# Backfill of existing history, run once after the kill_facts migration
+# ==============================================
+if __name__ == "__main__":
+    from reference_data import load_reference_data
+
+    data_dir = str(get_data_dir()) + "/"
+    logger = setup_logger("kill_facts", log_file=data_dir + "zkill_db_init.log", console=True)
+    config = load_config(data_dir, logger)
+
+    reference = load_reference_data(data_dir, logger)
+    conn = create_database_connection(data_dir + config["db_fname"], config)
+    try:
+        written = backfill_kill_facts(conn, reference, logger, config)
+    finally:
+        conn.close()
+    logger.info(f"kill_facts backfill complete, {written} rows written")
@@ -0,0 +1,96 @@
+# killmail_cache.py
+
+import json
+import sqlite3
+import threading
+import zlib
+
+from pathlib import Path
+
+
+class KillmailCache:
+    """
+    Persistent cache of raw killmail JSON keyed by (killmail_id, hash).
+
+    Killmails never change once they exist, so an entry never needs
+    refreshing.  Bodies are stored minified and zlib-compressed in a
+    single SQLite file.  When the stored bodies grow past max_bytes the
+    oldest entries are evicted until the cache is back under 90% of it.
+
+    Safe to share between threads, every access goes through one lock.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 2 * 1024 ** 3, logger=None, busy_timeout: int = 30000):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(self.path, timeout=busy_timeout / 1000.0, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        # A cache can lose its last writes on power loss, it never needs an fsync per entry
+        self.conn.execute("PRAGMA journal_mode = wal")
+        self.conn.execute("PRAGMA synchronous = normal")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS killmail_cache (
+                seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+                killmail_id INTEGER NOT NULL,
+                hash        TEXT    NOT NULL,
+                body        BLOB    NOT NULL,
+                UNIQUE (killmail_id, hash)
+            )
+        """)
+        self.total_bytes = self.conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM killmail_cache").fetchone()[0]
+
+    def get(self, killmail_id, kill_hash) -> dict | None:
+        """Return the cached killmail, or None on a miss."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT body FROM killmail_cache WHERE killmail_id = ? AND hash = ?",
+                (int(killmail_id), str(kill_hash))).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, killmail_id, kill_hash, killmail: dict):
+        """Store a killmail, an entry that is already cached is left alone."""
+        body = zlib.compress(json.dumps(killmail, separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO killmail_cache (killmail_id, hash, body) VALUES (?,?,?)",
+                (int(killmail_id), str(kill_hash), body))
+            if cursor.rowcount:
+                self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop the oldest entries until the cache is under 90% of max_bytes."""
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        while self.total_bytes > target:
+            rows = self.conn.execute(
+                "SELECT seq, LENGTH(body) FROM killmail_cache ORDER BY seq LIMIT 1000").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            last_seq = rows[0][0]
+            for seq, size in rows:
+                last_seq = seq
+                self.total_bytes -= size
+                evicted += 1
+                if self.total_bytes <= target:
+                    break
+            self.conn.execute("DELETE FROM killmail_cache WHERE seq <= ?", (last_seq,))
+        if self.logger:
+            self.logger.info(f"Killmail cache evicted {evicted} entries, {self.total_bytes} bytes left")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,182 @@
+# migrations.py
+
+import sqlite3
+
+# Schema changes applied on top of ZKillQuery_setup.sql, in order.  The
+# database's PRAGMA user_version is the last version applied, so every
+# migration runs exactly once, fresh database or not.  Append new
+# migrations to the end, never edit one that has shipped.
+MIGRATIONS = [
+    (1, "covering indexes for the report join paths", """
+        -- ModulesLost48Hours: killmails in range -> their items, quantity summed by type
+        CREATE INDEX IF NOT EXISTS idx_droppedItems_killmail_type
+            ON droppedItems (killmail_id, typeID, quantity);
+
+        -- Time range scans that only need the ship type and system
+        CREATE INDEX IF NOT EXISTS idx_killmails_time_ship_system
+            ON killmails (time, ship_type_id, solarSystemID);
+
+        -- ShipsByGroup / ShipKillsBySystem driven from the ship types of a group
+        CREATE INDEX IF NOT EXISTS idx_killmails_ship_system
+            ON killmails (ship_type_id, solarSystemID, time);
+
+        -- Types of a group, for the group filters
+        CREATE INDEX IF NOT EXISTS idx_invTypes_groupID
+            ON invTypes (groupID);
+    """),
+    (2, "integer epoch timestamps on killmails", """
+        ALTER TABLE killmails ADD COLUMN time_epoch INTEGER;
+
+        UPDATE killmails SET time_epoch = CAST(strftime('%s', time) AS INTEGER);
+
+        -- The time range indexes of migration 1, rebuilt on time_epoch
+        DROP INDEX IF EXISTS idx_killmails_time_ship_system;
+        DROP INDEX IF EXISTS idx_killmails_ship_system;
+
+        CREATE INDEX IF NOT EXISTS idx_killmails_epoch_ship_system
+            ON killmails (time_epoch, ship_type_id, solarSystemID);
+
+        CREATE INDEX IF NOT EXISTS idx_killmails_ship_system_epoch
+            ON killmails (ship_type_id, solarSystemID, time_epoch);
+    """),
+    (3, "denormalized kill_facts table", """
+        -- One row per killmail, see kill_facts.py.  security_band is
+        -- 2 highsec, 1 lowsec, 0 nullsec and wormholes.
+        CREATE TABLE IF NOT EXISTS kill_facts (
+            killmail_id   INTEGER PRIMARY KEY,
+            time_epoch    INTEGER NOT NULL,
+            solarSystemID INTEGER NOT NULL,
+            regionID      INTEGER NOT NULL,
+            security_band INTEGER NOT NULL,
+            ship_type_id  INTEGER NOT NULL,
+            groupID       INTEGER NOT NULL,
+            categoryID    INTEGER,
+            item_count    INTEGER NOT NULL,
+            total_value   REAL
+        );
+
+        -- Time windows, covering the group / region / ship breakdowns
+        CREATE INDEX IF NOT EXISTS idx_kill_facts_time
+            ON kill_facts (time_epoch, groupID, regionID, ship_type_id, solarSystemID);
+
+        -- Group filters over long windows
+        CREATE INDEX IF NOT EXISTS idx_kill_facts_group_time
+            ON kill_facts (groupID, time_epoch, regionID, ship_type_id);
+    """),
+    (4, "victims, attackers, kill values and destroyed / dropped quantities", """
+        -- NULL on rows recorded before the split, quantity holds their total
+        ALTER TABLE droppedItems ADD COLUMN quantity_destroyed INTEGER;
+        ALTER TABLE droppedItems ADD COLUMN quantity_dropped INTEGER;
+
+        CREATE TABLE IF NOT EXISTS victims (
+            killmail_id    INTEGER PRIMARY KEY,
+            character_id   INTEGER,
+            corporation_id INTEGER,
+            alliance_id    INTEGER,
+            faction_id     INTEGER,
+            ship_type_id   INTEGER,
+            damage_taken   INTEGER,
+            x              REAL,
+            y              REAL,
+            z              REAL
+        );
+
+        -- Append only and integers only, the one index is what joins need
+        CREATE TABLE IF NOT EXISTS attackers (
+            killmail_id    INTEGER NOT NULL,
+            character_id   INTEGER,
+            corporation_id INTEGER,
+            alliance_id    INTEGER,
+            faction_id     INTEGER,
+            ship_type_id   INTEGER,
+            weapon_type_id INTEGER,
+            damage_done    INTEGER NOT NULL,
+            final_blow     INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_attackers_killmail ON attackers (killmail_id);
+
+        -- zKillboard's valuation of the kill
+        CREATE TABLE IF NOT EXISTS kill_values (
+            killmail_id     INTEGER PRIMARY KEY,
+            total_value     REAL,
+            fitted_value    REAL,
+            destroyed_value REAL,
+            dropped_value   REAL,
+            points          INTEGER,
+            npc             INTEGER,
+            solo            INTEGER,
+            awox            INTEGER
+        );
+    """),
+    (5, "hourly kill and item rollups", """
+        -- Maintained by the consumer, see rollups.py.  hour is the epoch
+        -- second the hour starts at.  Run python3 rollups.py to fill them
+        -- from the history recorded before this migration.
+        CREATE TABLE IF NOT EXISTS kill_rollup_hourly (
+            hour          INTEGER NOT NULL,
+            solarSystemID INTEGER NOT NULL,
+            groupID       INTEGER NOT NULL,
+            ship_type_id  INTEGER NOT NULL,
+            regionID      INTEGER NOT NULL,
+            kills         INTEGER NOT NULL,
+            total_value   REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, solarSystemID, groupID, ship_type_id)
+        ) WITHOUT ROWID;
+
+        -- quantity is the total, the split is only known for items
+        -- recorded after migration 4
+        CREATE TABLE IF NOT EXISTS item_rollup_hourly (
+            hour               INTEGER NOT NULL,
+            typeID             INTEGER NOT NULL,
+            quantity           INTEGER NOT NULL,
+            quantity_destroyed INTEGER NOT NULL,
+            quantity_dropped   INTEGER NOT NULL,
+            PRIMARY KEY (hour, typeID)
+        ) WITHOUT ROWID;
+    """),
+    (6, "data generation counter", """
+        -- Small database wide values.  data_generation is bumped by every
+        -- commit that changes kill data, the webapp drops its cached
+        -- results when it moves.
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('data_generation', 0);
+    """),
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection, logger) -> int:
+    """
+    Apply every migration newer than the database's user_version, each
+    in its own transaction together with the version bump.
+
+    Returns the schema version the database is at afterwards.
+    """
+    version = schema_version(conn)
+    applied = 0
+
+    for migration_version, description, sql in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logger.info(f"Applying migration {migration_version}: {description}")
+        try:
+            conn.executescript(f"BEGIN;\n{sql}\nPRAGMA user_version = {int(migration_version)};\nCOMMIT;")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        version = migration_version
+        applied += 1
+
+    if applied:
+        conn.execute("PRAGMA optimize")
+        logger.info(f"Schema at version {version} after {applied} migrations")
+    else:
+        logger.info(f"Schema at version {version}, no migrations to apply")
+    return version
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# partitions.py
+
+import argparse
+import os
+import re
+import sqlite3
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from utils import setup_logger, get_data_dir, load_config, create_database_connection, run_with_lock_retry
+
+# Killmail history is split by month.  Consumers only ever write the
+# main database, which keeps the last hot_months months.  Older months
+# are moved by the archive command into one database file per month
+# under partition_dir, where the retention policy drops whole months by
+# deleting their file.  Readers attach the partitions a time range
+# needs, see attach_partitions.
+
+# Tables holding killmail history, every one keyed by killmail_id.
+# killmails comes last, rows referencing it are deleted first.
+PARTITIONED_TABLES = ("droppedItems", "kill_facts", "victims", "attackers", "kill_values", "killmails")
+
+PARTITION_PATTERN = re.compile(r"^killmails-(\d{4})-(\d{2})\.db$")
+
+
+class PartitionRangeError(ValueError):
+    """
+    A time range spans more partitions than SQLite can attach, results
+    would silently miss the oldest months.  covered_since is the oldest
+    epoch a query can start at.
+    """
+
+    def __init__(self, count: int, limit: int, covered_since: int):
+        self.covered_since = covered_since
+        super().__init__(f"The range spans {count} monthly partitions, only {limit} can be attached. "
+                         f"History is available since "
+                         f"{datetime.fromtimestamp(covered_since, timezone.utc).strftime('%Y-%m-%d')}")
+
+
+def partition_dir(data_dir: str, config: dict) -> Path:
+    return Path(data_dir) / config.get("partition_dir", "partitions")
+
+
+def partition_path(data_dir: str, config: dict, month: str) -> Path:
+    return partition_dir(data_dir, config) / f"killmails-{month}.db"
+
+
+def month_of(epoch: int) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m")
+
+
+def month_bounds(month: str) -> tuple[int, int]:
+    """Epoch seconds of the first second of month and of the month after it."""
+    year, month_number = (int(part) for part in month.split("-"))
+    start = datetime(year, month_number, 1, tzinfo=timezone.utc)
+    end = datetime(year + month_number // 12, month_number % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def add_months(month: str, count: int) -> str:
+    year, month_number = (int(part) for part in month.split("-"))
+    index = year * 12 + month_number - 1 + count
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+def list_partitions(data_dir: str, config: dict) -> list[tuple[str, Path]]:
+    """(month, path) of every partition file, oldest first."""
+    directory = partition_dir(data_dir, config)
+    if not directory.is_dir():
+        return []
+    partitions = []
+    for path in directory.iterdir():
+        match = PARTITION_PATTERN.match(path.name)
+        if match:
+            partitions.append((f"{match.group(1)}-{match.group(2)}", path))
+    return sorted(partitions)
+
+
+def table_columns(conn: sqlite3.Connection, table: str, schema: str = "main") -> list[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA "{schema}".table_info({table})')]
+
+
+def create_partition_schema(conn: sqlite3.Connection, schema: str):
+    """
+    Create the partitioned tables and their indexes in an attached
+    database, copied from main.  Foreign keys are left out, the tables
+    they reference only exist in main.
+    """
+    for table in PARTITIONED_TABLES:
+        columns = []
+        for _, name, column_type, _, _, pk in conn.execute(f"PRAGMA main.table_info({table})"):
+            columns.append(f"{name} {column_type}{' PRIMARY KEY' if pk == 1 else ''}")
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{schema}".{table} ({", ".join(columns)})')
+
+        indexes = conn.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))
+        for (sql,) in indexes.fetchall():
+            conn.execute(re.sub(r"^CREATE INDEX (IF NOT EXISTS )?(\w+)",
+                                f'CREATE INDEX IF NOT EXISTS "{schema}".\\2', sql.strip()))
+
+
+def archive_month(conn: sqlite3.Connection, data_dir: str, config: dict, month: str, logger,
+                  batch_size: int = 5000) -> int:
+    """
+    Move every killmail of month, with all its rows, from main into the
+    month's partition file, batch_size killmails at a time so the
+    consumers are never locked out for long.  Safe to run again after an
+    interruption.
+
+    A transaction is not atomic across attached databases in WAL mode,
+    so every batch is copied and committed in the partition first, and
+    only then deleted from main in a transaction of its own.  A crash in
+    between leaves the batch in both, the next run copies it again.
+
+    Returns the number of killmails moved.
+    """
+    path = partition_path(data_dir, config, month)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    start, end = month_bounds(month)
+
+    conn.execute("ATTACH DATABASE ? AS archive", (str(path),))
+    try:
+        create_partition_schema(conn, "archive")
+        conn.commit()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (killmail_id INTEGER PRIMARY KEY)")
+
+        columns = {table: ", ".join(table_columns(conn, table)) for table in PARTITIONED_TABLES}
+
+        def move_batch():
+            if conn.in_transaction:
+                conn.rollback()  # left over from a locked out attempt
+            conn.execute("DELETE FROM temp.archive_batch")
+            conn.execute("""
+                INSERT INTO temp.archive_batch
+                SELECT killmail_id FROM main.killmails
+                WHERE time_epoch >= ? AND time_epoch < ?
+                ORDER BY killmail_id LIMIT ?
+            """, (start, end, batch_size))
+            count = conn.execute("SELECT COUNT(*) FROM temp.archive_batch").fetchone()[0]
+            batch = f"killmail_id IN (SELECT killmail_id FROM temp.archive_batch)"
+            for table in PARTITIONED_TABLES:
+                # Rows a previous, interrupted run already copied are replaced
+                conn.execute(f"DELETE FROM archive.{table} WHERE {batch}")
+                conn.execute(f"INSERT INTO archive.{table} ({columns[table]}) "
+                             f"SELECT {columns[table]} FROM main.{table} WHERE {batch}")
+            conn.commit()
+
+            for table in PARTITIONED_TABLES:
+                conn.execute(f"DELETE FROM main.{table} WHERE {batch}")
+            conn.commit()
+            return count
+
+        moved = 0
+        while True:
+            count = run_with_lock_retry(move_batch, config=config, logger=logger)
+            if not count:
+                break
+            moved += count
+            logger.info(f"Archived {moved} killmails of {month} to {path}")
+        return moved
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("DETACH DATABASE archive")
+
+
+def archive_old_months(conn: sqlite3.Connection, data_dir: str, config: dict, logger) -> int:
+    """
+    Archive every month older than the hot_months newest ones, returns
+    killmails moved.  Months without kills get no partition file, every
+    file costs an attach slot.
+    """
+    hot_months = max(1, int(config.get("hot_months", 2)))
+    first_hot = add_months(month_of(int(datetime.now(timezone.utc).timestamp())), 1 - hot_months)
+
+    oldest = conn.execute("SELECT MIN(time_epoch) FROM main.killmails").fetchone()[0]
+    if oldest is None:
+        return 0
+
+    moved = 0
+    month = month_of(oldest)
+    while month < first_hot:
+        start, end = month_bounds(month)
+        has_kills = conn.execute("SELECT 1 FROM main.killmails WHERE time_epoch >= ? AND time_epoch < ? LIMIT 1",
+                                 (start, end)).fetchone()
+        if has_kills:
+            moved += archive_month(conn, data_dir, config, month, logger)
+        month = add_months(month, 1)
+    return moved
+
+
+def prune_partitions(data_dir: str, config: dict, logger) -> list[str]:
+    """
+    Apply retention_months, deleting the partition files of older
+    months.  Dropping a month costs one unlink, not a DELETE.
+
+    Returns the months dropped.
+    """
+    retention_months = int(config.get("retention_months", 0))
+    if retention_months <= 0:
+        return []
+
+    first_kept = add_months(month_of(int(datetime.now(timezone.utc).timestamp())), 1 - retention_months)
+    dropped = []
+    for month, path in list_partitions(data_dir, config):
+        if month < first_kept:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(f"{path}{suffix}")
+                except FileNotFoundError:
+                    pass
+            logger.info(f"Dropped partition {month} ({path})")
+            dropped.append(month)
+    return dropped
+
+
+@contextmanager
+def temp_schema_writes(conn: sqlite3.Connection):
+    """
+    Allow creating and dropping TEMP views on a query_only connection.
+    query_only counts them as writes, while the pooled read-only
+    connections open their files with mode=ro, which keeps the
+    databases themselves read-only.
+    """
+    query_only = conn.execute("PRAGMA query_only").fetchone()[0]
+    if query_only:
+        conn.execute("PRAGMA query_only = OFF")
+    try:
+        yield
+    finally:
+        if query_only:
+            conn.execute("PRAGMA query_only = ON")
+
+
+def attach_partitions(conn: sqlite3.Connection, data_dir: str, config: dict, since: int | None, logger=None,
+                      truncate: bool = False) -> list[str]:
+    """
+    Make the history since the epoch `since` readable through the usual
+    table names on conn.
+
+    Every partition holding kills after `since` is attached, and a TEMP
+    view per partitioned table unions it with main.  Unqualified names
+    resolve to the temp schema first, so queries need no change.  When
+    `since` lies inside the hot months nothing is attached and queries
+    only touch main.
+
+    More partitions than SQLITE_LIMIT_ATTACHED raise PartitionRangeError,
+    with truncate the newest ones that fit are attached instead.
+
+    Returns the months attached.
+    """
+    partitions = [(month, path) for month, path in list_partitions(data_dir, config)
+                  if since is None or month_bounds(month)[1] > since]
+    if not partitions:
+        return []
+
+    limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(partitions) > limit:
+        error = PartitionRangeError(len(partitions), limit, month_bounds(partitions[-limit][0])[0])
+        if not truncate:
+            raise error
+        if logger:
+            logger.info(str(error))
+        partitions = partitions[-limit:]
+
+    schemas = []
+    for month, path in partitions:
+        schema = "p_" + month.replace("-", "_")
+        conn.execute(f'ATTACH DATABASE ? AS "{schema}"', (str(path),))
+        schemas.append(schema)
+
+    with temp_schema_writes(conn):
+        for table in PARTITIONED_TABLES:
+            columns = ", ".join(table_columns(conn, table))
+            selects = [f"SELECT {columns} FROM main.{table}"]
+            selects += [f'SELECT {columns} FROM "{schema}".{table}' for schema in schemas]
+            conn.execute(f"CREATE TEMP VIEW IF NOT EXISTS {table} AS {' UNION ALL '.join(selects)}")
+
+    return [month for month, _ in partitions]
+
+
+def detach_partitions(conn: sqlite3.Connection):
+    """Undo attach_partitions, before a pooled connection is reused for another range."""
+    with temp_schema_writes(conn):
+        for table in PARTITIONED_TABLES:
+            conn.execute(f"DROP VIEW IF EXISTS temp.{table}")
+    for _, schema, _ in conn.execute("PRAGMA database_list").fetchall():
+        if schema.startswith("p_"):
+            conn.execute(f'DETACH DATABASE "{schema}"')
+
+
+# ==============================================
+# Maintenance commands, run from cron or by hand
+# ==============================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Archive old killmail months into partitions and apply retention.')
+    parser.add_argument('command', choices=['archive', 'prune', 'list'],
+                        help='archive months older than hot_months, prune partitions older than '
+                             'retention_months, or list the partitions')
+    args = parser.parse_args()
+
+    data_dir = str(get_data_dir()) + "/"
+    logger = setup_logger("partitions", log_file=data_dir + "zkill_db_init.log", console=True)
+    config = load_config(data_dir, logger)
+
+    if args.command == 'archive':
+        conn = create_database_connection(data_dir + config["db_fname"], config)
+        try:
+            moved = archive_old_months(conn, data_dir, config, logger)
+        finally:
+            conn.close()
+        logger.info(f"Archive complete, {moved} killmails moved")
+    elif args.command == 'prune':
+        dropped = prune_partitions(data_dir, config, logger)
+        logger.info(f"Prune complete, {len(dropped)} partitions dropped")
+    else:
+        for month, path in list_partitions(data_dir, config):
+            print(f"{month}  {path}  {path.stat().st_size:,} bytes")
@@ -0,0 +1,401 @@
+# queue_backend.py
+
+import gzip
+import heapq
+import json
+import os
+import sqlite3
+import time
+
+from pathlib import Path
+
+from utils import generate_timestamp, release_file_to_queue
+
+# Optional payload formats, only available when the package is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# queue_format -> file suffix used by the directory backend
+QUEUE_FORMATS = {
+    "json": ".json",
+    "json.gz": ".json.gz",
+    "json.zst": ".json.zst",
+    "msgpack": ".msgpack",
+}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+# zkb fields carried besides the hash.  The system keys let the consumer
+# skip kills outside its regions before any ESI fetch, the values end up
+# in kill_values.
+ZKB_KEEP = ("solarSystemID", "solar_system_id", "systemID", "locationID", "totalValue", "fittedValue", "destroyedValue", "droppedValue",
+            "points", "npc", "solo", "awox")
+
+
+def compact_package(data: dict) -> dict:
+    """
+    Strip a RedisQ response down to the fields the consumer reads.
+
+    The result keeps the RedisQ {"package": ...} shape, so compact and
+    full packages are read the same way.
+    """
+    package = data["package"]
+    zkb = package.get("zkb") or {}
+
+    compact_zkb = {"hash": zkb["hash"]}
+    for key in ZKB_KEEP:
+        if key in zkb:
+            compact_zkb[key] = zkb[key]
+
+    compact = {"killID": package["killID"], "zkb": compact_zkb}
+    if isinstance(package.get("killmail"), dict):
+        compact["killmail"] = package["killmail"]
+
+    return {"package": compact}
+
+
+def encode_payload(data: dict, queue_format: str = "json") -> bytes:
+    """Serialize a queued package in queue_format, see QUEUE_FORMATS."""
+    if queue_format == "msgpack":
+        if msgpack is None:
+            raise ValueError("queue_format msgpack needs the msgpack package")
+        return msgpack.packb(data)
+
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    if queue_format == "json":
+        return body
+    if queue_format == "json.gz":
+        return gzip.compress(body)
+    if queue_format == "json.zst":
+        if zstandard is None:
+            raise ValueError("queue_format json.zst needs the zstandard package")
+        return zstandard.ZstdCompressor().compress(body)
+    raise ValueError(f"Unknown queue_format: {queue_format}")
+
+
+def decode_payload(payload: bytes) -> dict:
+    """
+    Read a queued package in any of the QUEUE_FORMATS, or the pretty
+    printed JSON of older producers.  The format is recognised from the
+    payload itself.  Raises ValueError if it cannot be decoded.
+    """
+    try:
+        if payload.startswith(GZIP_MAGIC):
+            payload = gzip.decompress(payload)
+        elif payload.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError("zstd payload but the zstandard package is not installed")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        elif payload[:1] not in (b"{", b" ", b"\t", b"\r", b"\n") and msgpack is not None:
+            return msgpack.unpackb(payload)
+        return json.loads(payload)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Unable to decode payload: {e}") from e
+
+
+class QueueItem:
+    """A claimed queue entry, handed back to the queue to ack or release it."""
+
+    def __init__(self, key, payload: bytes):
+        self.key = key
+        self.payload = payload
+        self.killID = None  # set by the consumer once the payload is decoded
+        self.zkb = None     # the package's zkb block, likewise
+
+    def __str__(self):
+        return str(self.key)
+
+
+def split_retry_suffix(name: str) -> tuple[str, int]:
+    """Split "<name>.retry-<n>" into (name, n), a name without the suffix has 0 attempts."""
+    base, sep, attempts = name.rpartition('.retry-')
+    if sep and attempts.isdigit():
+        return base, int(attempts)
+    return name, 0
+
+
+class DirectoryQueue:
+    """
+    The original queue layout: one file per package in queue/.
+
+    Kept as the compatibility backend.  A claim renames the file to
+    *.processing-<consumer_id> and sets its mtime, which is the lease:
+    the consumer refreshes it with touch() while it works, and
+    reclaim_stale() returns files whose lease expired to the queue.
+    Failed attempts are counted in a .retry-<n> suffix, after
+    max_retries the file moves to the dead/ subdirectory.
+    """
+
+    def __init__(self, directory: str | Path, lease_seconds: float = 300, max_retries: int = 5):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.dead_directory = self.directory / "dead"
+        self.dead_directory.mkdir(exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+
+    def put(self, payload: bytes, suffix: str = ".json") -> str:
+        """Add a package, written to a hidden file first so a consumer never sees it half written."""
+        filename = generate_timestamp() + suffix
+        tmp_path = self.directory / ("." + filename)
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        tmp_path.rename(self.directory / filename)
+        return filename
+
+    def put_many(self, payloads: list[bytes], suffix: str = ".json") -> list[str]:
+        return [self.put(payload, suffix) for payload in payloads]
+
+    def claim(self, consumer_id: str, count: int = 1) -> list[QueueItem]:
+        """Claim up to count of the oldest packages."""
+        with os.scandir(self.directory) as entries:
+            names = [
+                entry.name for entry in entries
+                if entry.is_file() and not entry.name.startswith('.') and '.processing-' not in entry.name
+            ]
+
+        claimed = []
+        # Oldest first, past the ones other consumers claim first until
+        # count are claimed or the listing runs out
+        heapq.heapify(names)
+        while names and len(claimed) < count:
+            name = heapq.heappop(names)
+            source = self.directory / name
+            claimed_file = source.with_name(f"{name}.processing-{consumer_id}")
+            try:
+                # Atomic rename - only one consumer can succeed
+                source.rename(claimed_file)
+                os.utime(claimed_file)  # start of the lease
+                payload = claimed_file.read_bytes()
+            except (FileExistsError, FileNotFoundError, PermissionError):
+                continue  # Another consumer claimed or reclaimed it first
+            claimed.append(QueueItem(claimed_file, payload))
+        return claimed
+
+    def ack(self, item: QueueItem):
+        """The package is done with, remove it."""
+        if item.key.exists():
+            item.key.unlink()
+
+    def release(self, item: QueueItem):
+        """Put the package back so it is claimed again, without counting an attempt."""
+        release_file_to_queue(item.key)
+
+    def touch(self, items: list[QueueItem]):
+        """Heartbeat, extend the lease of items still being worked on."""
+        for item in items:
+            try:
+                os.utime(item.key)
+            except FileNotFoundError:
+                pass
+
+    def fail(self, item: QueueItem, reason: str) -> bool:
+        """
+        Count a failed attempt and put the package back for a retry.
+        Returns True if it was moved to dead/ instead.
+        """
+        name = item.key.name.rpartition('.processing-')[0]
+        return self._retry_or_dead(item.key, name)
+
+    def dead_letter(self, item: QueueItem, reason: str):
+        """Move a package that can never succeed straight to dead/."""
+        name = item.key.name.rpartition('.processing-')[0]
+        self._move_to_dead(item.key, split_retry_suffix(name)[0])
+
+    def reclaim_stale(self) -> int:
+        """Return files whose lease expired, their consumer died, to the queue."""
+        cutoff = time.time() - self.lease_seconds
+        reclaimed = 0
+        with os.scandir(self.directory) as entries:
+            stale = [
+                Path(entry.path) for entry in entries
+                if entry.is_file() and '.processing-' in entry.name and entry.stat().st_mtime < cutoff
+            ]
+        for path in stale:
+            self._retry_or_dead(path, path.name.rpartition('.processing-')[0])
+            reclaimed += 1
+        return reclaimed
+
+    def _retry_or_dead(self, path: Path, name: str) -> bool:
+        base, attempts = split_retry_suffix(name)
+        attempts += 1
+        if attempts > self.max_retries:
+            self._move_to_dead(path, base)
+            return True
+        try:
+            path.rename(self.directory / f"{base}.retry-{attempts}")
+        except FileNotFoundError:
+            pass  # Another consumer reclaimed it first
+        return False
+
+    def _move_to_dead(self, path: Path, base: str):
+        try:
+            path.rename(self.dead_directory / base)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        pass
+
+
+class SQLiteQueue:
+    """
+    Queue table in its own SQLite file.
+
+    Claiming is an index seek on the unclaimed rows, so its cost does
+    not grow with the backlog, and both put and claim work in batches
+    of one transaction.  claimed_at is the lease, see DirectoryQueue,
+    and packages that fail more than max_retries times move to the
+    dead_letters table.
+    """
+
+    def __init__(self, path: str | Path, busy_timeout: int = 30000,
+                 lease_seconds: float = 300, max_retries: int = 5):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds
+        self.max_retries = max_retries
+        self.conn = sqlite3.connect(self.path, timeout=busy_timeout / 1000.0, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = wal")
+        self.conn.execute("PRAGMA synchronous = normal")
+        self.conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS queue (
+                id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload    BLOB    NOT NULL,
+                claimed_by TEXT,
+                claimed_at REAL,
+                attempts   INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS queue_unclaimed ON queue (id) WHERE claimed_by IS NULL;
+            CREATE INDEX IF NOT EXISTS queue_claimed ON queue (claimed_at) WHERE claimed_by IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id        INTEGER PRIMARY KEY,
+                payload   BLOB    NOT NULL,
+                attempts  INTEGER NOT NULL,
+                reason    TEXT,
+                failed_at REAL
+            );
+        """)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(queue)")]
+        if "attempts" not in columns:
+            self.conn.execute("ALTER TABLE queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+    def put(self, payload: bytes, suffix: str = ".json") -> int:
+        return self.put_many([payload])[0]
+
+    def put_many(self, payloads: list[bytes], suffix: str = ".json") -> list[int]:
+        ids = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for payload in payloads:
+                cursor = self.conn.execute("INSERT INTO queue (payload) VALUES (?)", (payload,))
+                ids.append(cursor.lastrowid)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return ids
+
+    def claim(self, consumer_id: str, count: int = 1) -> list[QueueItem]:
+        """Claim up to count of the oldest unclaimed packages in one transaction."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute("""
+                UPDATE queue SET claimed_by = ?, claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM queue WHERE claimed_by IS NULL ORDER BY id LIMIT ?
+                )
+                RETURNING id, payload
+            """, (consumer_id, time.time(), count)).fetchall()
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [QueueItem(row_id, payload) for row_id, payload in sorted(rows)]
+
+    def ack(self, item: QueueItem):
+        self.conn.execute("DELETE FROM queue WHERE id = ?", (item.key,))
+
+    def release(self, item: QueueItem):
+        self.conn.execute("UPDATE queue SET claimed_by = NULL, claimed_at = NULL WHERE id = ?", (item.key,))
+
+    def touch(self, items: list[QueueItem]):
+        now = time.time()
+        self.conn.executemany("UPDATE queue SET claimed_at = ? WHERE id = ?", [(now, item.key) for item in items])
+
+    def fail(self, item: QueueItem, reason: str) -> bool:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute("""
+                UPDATE queue SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1
+                WHERE id = ?
+            """, (item.key,))
+            dead = self._move_to_dead("attempts > ? AND id = ?", (self.max_retries, item.key), reason)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return dead > 0
+
+    def dead_letter(self, item: QueueItem, reason: str):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._move_to_dead("id = ?", (item.key,), reason)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def reclaim_stale(self) -> int:
+        cutoff = time.time() - self.lease_seconds
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            reclaimed = self.conn.execute("""
+                UPDATE queue SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1
+                WHERE claimed_by IS NOT NULL AND claimed_at < ?
+            """, (cutoff,)).rowcount
+            self._move_to_dead("attempts > ?", (self.max_retries,), "lease expired")
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return reclaimed
+
+    def _move_to_dead(self, where: str, params: tuple, reason: str) -> int:
+        self.conn.execute(f"""
+            INSERT OR REPLACE INTO dead_letters (id, payload, attempts, reason, failed_at)
+            SELECT id, payload, attempts, ?, ? FROM queue WHERE {where}
+        """, (reason, time.time()) + params)
+        return self.conn.execute(f"DELETE FROM queue WHERE {where}", params).rowcount
+
+    def close(self):
+        self.conn.close()
+
+
+def open_queue(config: dict, data_dir: str):
+    """
+    Open the queue backend selected by config.json.
+
+    "queue_backend": "directory" (default) keeps one file per package in
+    <data_dir>/queue/, "sqlite" uses the queue table in queue_fname.
+    """
+    backend = config.get("queue_backend", "directory")
+    lease_seconds = float(config.get("queue_lease_seconds", 300))
+    max_retries = int(config.get("queue_max_retries", 5))
+    if backend == "directory":
+        return DirectoryQueue(data_dir + "queue/", lease_seconds, max_retries)
+    if backend == "sqlite":
+        return SQLiteQueue(data_dir + config.get("queue_fname", "queue.db"),
+                           lease_seconds=lease_seconds, max_retries=max_retries)
+    raise ValueError(f"Unknown queue_backend: {backend}")
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# reference_data.py
+
+import array
+import bisect
+import csv
+import math
+import mmap
+import os
+import struct
+
+from pathlib import Path
+
+# Compiled lookup tables built from the Fuzzwork CSVs.  Only the columns
+# the pipeline uses are kept, each as a flat typed array, so the file can
+# be mmap'ed and shared between every process that loads it.
+
+REFERENCE_MAGIC = b"ZKRD"
+REFERENCE_VERSION = 1
+REFERENCE_FNAME = "reference_data.bin"
+
+# CSV file -> (table name, [(column, csv header, typecode)]), typecode "s" is a string
+SOURCE_CSVS = {
+    "invTypes.csv": ("types", [("id", "typeID", "i"), ("group", "groupID", "i"), ("name", "typeName", "s")]),
+    "invGroups.csv": ("groups", [("id", "groupID", "i"), ("category", "categoryID", "i"), ("name", "groupName", "s")]),
+    "mapSolarSystems.csv": ("systems", [("id", "solarSystemID", "i"), ("region", "regionID", "i"),
+                                        ("security", "security", "d"), ("name", "solarSystemName", "s")]),
+    "mapRegions.csv": ("regions", [("id", "regionID", "i"), ("name", "regionName", "s")]),
+}
+
+_HEADER = struct.Struct("<4sII")           # magic, version, column count
+_COLUMN = struct.Struct("<32s2sxxxxxxQQ")  # name, typecode, byte offset, item count
+
+
+def _parse_value(value: str, typecode: str):
+    if typecode == "s":
+        return value
+    if not value or value == "None":
+        return math.nan if typecode == "d" else 0
+    return float(value) if typecode == "d" else int(float(value))
+
+
+def _read_table(csv_path: Path, columns) -> dict[str, list]:
+    """Read only the needed columns of a CSV, sorted by the id column."""
+    with open(csv_path, mode='r', encoding='utf-8') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        headers = next(csv_reader)
+        indexes = [headers.index(header) for _, header, _ in columns]
+        rows = [
+            tuple(_parse_value(row[index], typecode) for index, (_, _, typecode) in zip(indexes, columns))
+            for row in csv_reader if row
+        ]
+    rows.sort(key=lambda row: row[0])
+    return {name: [row[i] for row in rows] for i, (name, _, _) in enumerate(columns)}
+
+
+def compile_reference_data(data_dir: str, out_path: str | Path | None = None, logger=None) -> Path:
+    """
+    Compile the reference CSVs in data_dir into one binary file.
+
+    Every column is stored as a typed array.  A string column becomes
+    two arrays, "<name>_off" with the offset of every string into the
+    UTF-8 "<name>_str" bytes (one extra trailing offset).
+    """
+    out_path = Path(out_path or data_dir + REFERENCE_FNAME)
+    arrays = []
+
+    for csv_name, (table, columns) in SOURCE_CSVS.items():
+        data = _read_table(Path(data_dir) / csv_name, columns)
+        if logger:
+            logger.info(f"Compiling {csv_name}: {len(data['id'])} rows")
+        for name, _, typecode in columns:
+            if typecode == "s":
+                encoded = [value.encode('utf-8') for value in data[name]]
+                offsets = array.array("I", [0])
+                for value in encoded:
+                    offsets.append(offsets[-1] + len(value))
+                arrays.append((f"{table}.{name}_off", offsets))
+                arrays.append((f"{table}.{name}_str", array.array("B", b"".join(encoded))))
+            else:
+                arrays.append((f"{table}.{name}", array.array(typecode, data[name])))
+
+    # Header and column directory first, then every array 8 byte aligned
+    offset = _HEADER.size + _COLUMN.size * len(arrays)
+    directory = []
+    for name, values in arrays:
+        offset = (offset + 7) & ~7
+        directory.append(_COLUMN.pack(name.encode('ascii'), values.typecode.encode('ascii'), offset, len(values)))
+        offset += values.itemsize * len(values)
+
+    tmp_path = out_path.with_name(f".{out_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(REFERENCE_MAGIC, REFERENCE_VERSION, len(arrays)))
+        f.writelines(directory)
+        for name, values in arrays:
+            f.write(b"\0" * (-f.tell() % 8))
+            values.tofile(f)
+    tmp_path.rename(out_path)  # readers never see a half written file
+
+    if logger:
+        logger.info(f"Compiled reference data to {out_path} ({out_path.stat().st_size} bytes)")
+    return out_path
+
+
+class ReferenceTables:
+    """
+    Read-only view of a compiled reference data file.
+
+    The file is mmap'ed, so loading costs next to nothing and processes
+    loading the same file share its pages.  Lookups binary search the
+    sorted id column of a table and return its row index, or -1.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+
+        magic, version, count = _HEADER.unpack_from(view, 0)
+        if magic != REFERENCE_MAGIC or version != REFERENCE_VERSION:
+            raise ValueError(f"{self.path} is not reference data version {REFERENCE_VERSION}")
+
+        self.columns = {}
+        for i in range(count):
+            name, typecode, offset, items = _COLUMN.unpack_from(view, _HEADER.size + i * _COLUMN.size)
+            typecode = typecode.rstrip(b"\0").decode('ascii')
+            size = struct.calcsize(typecode) * items
+            self.columns[name.rstrip(b"\0").decode('ascii')] = view[offset:offset + size].cast(typecode)
+
+    def find(self, table: str, key: int) -> int:
+        ids = self.columns[f"{table}.id"]
+        index = bisect.bisect_left(ids, key)
+        if index < len(ids) and ids[index] == key:
+            return index
+        return -1
+
+    def value(self, table: str, column: str, index: int):
+        return self.columns[f"{table}.{column}"][index]
+
+    def string(self, table: str, column: str, index: int) -> str:
+        offsets = self.columns[f"{table}.{column}_off"]
+        strings = self.columns[f"{table}.{column}_str"]
+        return bytes(strings[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def ids(self, table: str):
+        return self.columns[f"{table}.id"]
+
+
+class ItemType:
+    __slots__ = ("type_id", "group_id", "name")
+
+    def __init__(self, type_id: int, group_id: int, name: str):
+        self.type_id = type_id
+        self.group_id = group_id
+        self.name = name
+
+
+class Group:
+    __slots__ = ("group_id", "category_id", "name")
+
+    def __init__(self, group_id: int, category_id: int, name: str):
+        self.group_id = group_id
+        self.category_id = category_id
+        self.name = name
+
+
+class SolarSystem:
+    __slots__ = ("system_id", "region_id", "security", "name")
+
+    def __init__(self, system_id: int, region_id: int, security: float, name: str):
+        self.system_id = system_id
+        self.region_id = region_id
+        self.security = security
+        self.name = name
+
+
+class Region:
+    __slots__ = ("region_id", "name")
+
+    def __init__(self, region_id: int, name: str):
+        self.region_id = region_id
+        self.name = name
+
+
+class ReferenceData:
+    """
+    The one lookup API for reference data, used by the consumer, the
+    reports and the webapp.
+
+    Every lookup takes an int id and returns a small __slots__ record,
+    or None for an unknown id.  Records are built from the compiled
+    tables the first time an id is looked up and kept afterwards, so the
+    hot path pays for one dict lookup per id.
+    """
+
+    def __init__(self, tables: ReferenceTables):
+        self.tables = tables
+        self.types = {}
+        self.groups = {}
+        self.systems = {}
+        self.regions = {}
+        self.names = {}  # table -> {lower case name: [ids]}, built on first use
+
+    def _record(self, cache: dict, table: str, key: int, build):
+        record = cache.get(key)
+        if record is None:
+            index = self.tables.find(table, key)
+            if index < 0:
+                return None
+            record = cache[key] = build(index)
+        return record
+
+    def item_type(self, type_id: int) -> ItemType | None:
+        tables = self.tables
+        return self._record(self.types, "types", type_id, lambda i: ItemType(
+            type_id, tables.value("types", "group", i), tables.string("types", "name", i)))
+
+    def group(self, group_id: int) -> Group | None:
+        tables = self.tables
+        return self._record(self.groups, "groups", group_id, lambda i: Group(
+            group_id, tables.value("groups", "category", i), tables.string("groups", "name", i)))
+
+    def system(self, system_id: int) -> SolarSystem | None:
+        tables = self.tables
+        return self._record(self.systems, "systems", system_id, lambda i: SolarSystem(
+            system_id, tables.value("systems", "region", i), tables.value("systems", "security", i),
+            tables.string("systems", "name", i)))
+
+    def region(self, region_id: int) -> Region | None:
+        tables = self.tables
+        return self._record(self.regions, "regions", region_id, lambda i: Region(
+            region_id, tables.string("regions", "name", i)))
+
+    def _ids_by_name(self, table: str, name: str) -> list[int]:
+        if table not in self.names:
+            names = {}
+            ids = self.tables.ids(table)
+            for index in range(len(ids)):
+                names.setdefault(self.tables.string(table, "name", index).lower(), []).append(ids[index])
+            self.names[table] = names
+        return self.names[table].get(name.lower(), [])
+
+    def group_ids_by_name(self, name: str) -> list[int]:
+        """groupIDs whose name matches, case insensitive."""
+        return self._ids_by_name("groups", name)
+
+    def region_ids_by_name(self, name: str) -> list[int]:
+        """regionIDs whose name matches, case insensitive."""
+        return self._ids_by_name("regions", name)
+
+    def systems_in_regions(self, region_ids) -> set[int]:
+        """solarSystemIDs of every system in one of region_ids."""
+        region_ids = set(region_ids)
+        system_ids = self.tables.ids("systems")
+        regions = self.tables.columns["systems.region"]
+        return {system_ids[i] for i in range(len(system_ids)) if regions[i] in region_ids}
+
+
+def load_reference_tables(data_dir: str, logger=None, fname: str = REFERENCE_FNAME) -> ReferenceTables:
+    """
+    Load the compiled reference data, compiling it first when it is
+    missing or older than one of the CSVs it is built from.  A
+    deployment may ship the compiled file alone, missing CSVs are only
+    an error when there is nothing compiled to load.
+    """
+    path = Path(data_dir + fname)
+    sources = [Path(data_dir + csv_name) for csv_name in SOURCE_CSVS]
+    missing = [str(source) for source in sources if not source.exists()]
+
+    if missing:
+        if not path.exists():
+            raise FileNotFoundError(f"No reference data at {path} and missing CSVs to compile it: {', '.join(missing)}")
+    elif not path.exists() or any(source.stat().st_mtime > path.stat().st_mtime for source in sources):
+        if logger:
+            logger.info(f"Reference data {path} missing or stale, compiling")
+        compile_reference_data(data_dir, path, logger)
+
+    return ReferenceTables(path)
+
+
+def load_reference_data(data_dir: str, logger=None, fname: str = REFERENCE_FNAME) -> ReferenceData:
+    """ReferenceData over the compiled tables, see load_reference_tables."""
+    return ReferenceData(load_reference_tables(data_dir, logger, fname))
+
+
+# ==============================================
+# Compile step, run once after downloading new CSVs
+# ==============================================
+if __name__ == "__main__":
+    from utils import setup_logger, get_data_dir
+
+    data_dir = str(get_data_dir()) + "/"
+    logger = setup_logger("reference_data", log_file=data_dir + "zkill_db_init.log", console=True)
+    compile_reference_data(data_dir, logger=logger)
@@ -10,7 +10,11 @@ from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
 from dateutil.parser import isoparse
 
-from utils import get_data_dir, load_config, setup_logger
+from contextlib import closing
+
+from partitions import attach_partitions, detach_partitions
+from reference_data import load_reference_data
+from utils import get_data_dir, load_config, setup_logger, create_database_connection, run_with_lock_retry, epoch_days_ago
 
 
 def convertISOTime(isotime):
@@ -31,14 +35,34 @@ class Report(ABC):
     """Base class for ZKill reports."""
     
     days_back = 2
+    # False for reports on the rollup tables, which are never archived,
+    # so no partitions are attached for them
+    reads_history = True
     
     def __init__(self, name=None):
         self.name = name or self.__class__.__name__
         self.config = {}
         self.db_path: str = ""
+        self.data_dir: str = ""
         self.logger = None
+        self.reference = None
+        self.pool = None
+        
+    def setup(self, shared=None):
+        """
+        Load config and reference data.  With shared, an object loaded
+        once per process such as the webapp's AppState, reuse its config,
+        logger and reference data and borrow its pooled connections.
+        """
+        if shared is not None:
+            self.logger = shared.logger
+            self.config = shared.config
+            self.data_dir = shared.data_dir
+            self.db_path = shared.db_path
+            self.reference = shared.reference
+            self.pool = shared.pool
+            return
         
-    def setup(self):
         data_dir_path = get_data_dir()
         data_dir = str(data_dir_path) + "/"
         
@@ -46,21 +70,41 @@ class Report(ABC):
         self.logger = setup_logger(self.name, log_file=log_file, console=True)
         
         self.config = load_config(data_dir, self.logger)
+        self.data_dir = data_dir
         self.db_path = data_dir + self.config["db_fname"]
+        self.reference = load_reference_data(data_dir, self.logger)
         
-    def get_past_date(self, days=None):
+    def get_past_date(self, days=None) -> int:
+        """Epoch seconds `days` back from now, compared against killmails.time_epoch."""
         days = days or self.days_back
-        now = datetime.now()
-        past = now - timedelta(days=days)
-        return past.isoformat()
+        return epoch_days_ago(days)
+    
+    def connect(self):
+        """Connection for one query, borrowed from the pool when setup was given one."""
+        if self.pool is not None:
+            return self.pool.connection()
+        return closing(create_database_connection(self.db_path, self.config))
     
-    def execute_query(self, query, params=None):
+    def execute_query(self, query, params=None, since=None):
+        """
+        Run query and return all rows, None on a database error.  With
+        since (epoch seconds) the archived months after it are attached,
+        so the query sees all history from then on under the usual names.
+        Reports that do not read history ignore since.
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                cursor = conn.cursor()
-                cursor.execute(query, params or ())
-                return cursor.fetchall()
+            with self.connect() as conn:
+                attached = []
+                try:
+                    if since is not None and self.reads_history:
+                        attached = attach_partitions(conn, self.data_dir, self.config, since, self.logger)
+                    conn.row_factory = sqlite3.Row
+                    cursor = conn.cursor()
+                    run_with_lock_retry(cursor.execute, query, params or (), config=self.config, logger=self.logger)
+                    return cursor.fetchall()
+                finally:
+                    if attached:
+                        detach_partitions(conn)
         except sqlite3.Error as e:
             if self.logger:
                 self.logger.error(f"Database error: {e}")
@@ -70,16 +114,37 @@ class Report(ABC):
         """Convert sqlite3.Row to dict for JSON serialization."""
         return dict(row)
     
+    def query_params(self, past_date: int) -> tuple | None:
+        """Parameters for build_query, None when the filters match nothing."""
+        return (past_date,)
+    
     def get_data(self, past_date) -> list[dict]:
         """Data layer - returns JSON-serializable list of dicts."""
         query = self.build_query(past_date=past_date)
-        results = self.execute_query(query, (past_date,))
+        results = self.execute_query(query, self.query_params(past_date), since=past_date)
         if results:
             return [self._row_to_dict(row) for row in results]
         return []
     
+    def explain(self, past_date=None) -> list[str]:
+        """EXPLAIN QUERY PLAN of the report query, one indented line per step."""
+        if past_date is None:
+            past_date = self.get_past_date()
+        query = self.build_query(past_date=past_date)
+        params = self.query_params(past_date)
+        if query is None or params is None:
+            return []
+        
+        lines = []
+        depth = {}
+        for row in self.execute_query("EXPLAIN QUERY PLAN " + query, params, since=past_date) or []:
+            level = depth.get(row["parent"], -1) + 1
+            depth[row["id"]] = level
+            lines.append("  " * level + row["detail"])
+        return lines
+    
     @abstractmethod
-    def build_query(self, past_date: str) -> str | None:
+    def build_query(self, past_date: int) -> str | None:
         """Return SQL query string"""
         pass
     
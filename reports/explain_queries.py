@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import re
+
+from registry import REPORTS, create_report
+
+
+# Tables that grow with the kill history, what the reports read now
+# and what they read before kill_facts and the rollups
+HISTORY_TABLES = ("kill_facts", "kill_rollup_hourly", "item_rollup_hourly", "killmails", "droppedItems")
+
+SQL_KEYWORDS = {"where", "join", "on", "group", "order", "left", "inner", "cross", "natural",
+                "limit", "union", "using", "indexed", "not", "as"}
+
+
+def history_names(query: str) -> set[str]:
+    """
+    The history tables a query reads and the aliases it gives them.  Query
+    plans name a table by its alias, SCAN kf rather than SCAN kill_facts.
+    """
+    names = set(HISTORY_TABLES)
+    pattern = r"\b(?:%s)\b\s+(?:AS\s+)?(\w+)" % "|".join(HISTORY_TABLES)
+    for alias in re.findall(pattern, query or "", re.IGNORECASE):
+        if alias.lower() not in SQL_KEYWORDS:
+            names.add(alias)
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the EXPLAIN QUERY PLAN of every registered report.')
+    parser.add_argument('reports', nargs='*', help='Reports to explain (default: all)')
+    parser.add_argument('-r', '--region', type=str, default=None,
+                        help='Also apply a region filter where a report has one')
+    args = parser.parse_args()
+
+    scans = 0
+    for name in args.reports or REPORTS:
+        report = create_report(name)
+        if args.region and hasattr(report, "region_filter"):
+            report.region_filter = args.region
+
+        names = history_names(report.build_query(past_date=report.get_past_date()))
+        print(f"== {name}")
+        for line in report.explain():
+            print(f"   {line}")
+            # A full scan of a history table is what an index should prevent
+            words = line.split()
+            if len(words) > 1 and words[0] == "SCAN" and words[1] in names:
+                scans += 1
+                print("   ^^^ full scan of a history table")
+        print()
+
+    if scans:
+        print(f"{scans} full scans of history tables")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,20 +6,19 @@ from ZKillReports import Report
 class ModulesLost48Hours(Report):
     name = "modules_lost_48hours"
     days_back = 2
+    reads_history = False
     
     def build_query(self, past_date):
         return """
             SELECT
                 it.typeName AS item_type,
-                SUM(di.quantity) as total_destroyed
+                SUM(r.quantity) as total_destroyed
             FROM
-                droppedItems di
+                item_rollup_hourly r
             JOIN
-                killmails km ON di.killmail_id = km.killmail_id
-            JOIN
-                invTypes it ON di.typeID = it.typeID
+                invTypes it ON r.typeID = it.typeID
             WHERE
-                km.time > ?
+                r.hour > ? - 3600
             GROUP BY
                 item_type
             ORDER BY
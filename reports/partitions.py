@@ -0,0 +1 @@
+../partitions.py
\ No newline at end of file
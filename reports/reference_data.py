@@ -0,0 +1 @@
+../reference_data.py
\ No newline at end of file
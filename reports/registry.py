@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from modules_lost_48hours import ModulesLost48Hours
+from ship_kills_by_system import ShipKillsBySystem
+from ships_by_group import ShipsByGroup
+from ships_lost_48hours import ShipsLost48Hours
+
+# Every report, with the filters used when checking its query plan
+REPORTS = {
+    "modules_lost_48hours": (ModulesLost48Hours, {}),
+    "ships_lost_48hours": (ShipsLost48Hours, {}),
+    "ships_by_group": (ShipsByGroup, {"group_filter": "hauling"}),
+    "ship_kills_by_system": (ShipKillsBySystem, {"ship_filter": "hauling"}),
+}
+
+
+def create_report(name, **filters):
+    """Set up the named report, filters override its registered defaults."""
+    report_class, defaults = REPORTS[name]
+    report = report_class()
+    report.setup()
+    for attribute, value in {**defaults, **filters}.items():
+        setattr(report, attribute, value)
+    return report
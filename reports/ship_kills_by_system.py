@@ -80,11 +80,12 @@ Examples:
         if filter_val in self.GROUP_MAP:
             return [self.GROUP_MAP[filter_val]]
         
-        query = "SELECT groupID FROM invGroups WHERE LOWER(groupName) = ?"
-        result = self.execute_query(query, (filter_val,))
-        if result:
-            return [result[0]['groupID']]
-        return None
+        return self.reference.group_ids_by_name(filter_val) or None
+    
+    def get_region_ids(self) -> list[int] | None:
+        if not self.region_filter:
+            return None
+        return self.reference.region_ids_by_name(self.region_filter)
     
     def build_query(self, past_date):
         group_ids = self.get_group_ids()
@@ -93,52 +94,56 @@ Examples:
         
         placeholders = ','.join('?' * len(group_ids))
         
+        # Filtered on kill_facts alone, names are looked up per kill
         query = f"""
             SELECT
                 s.solarSystemName AS system_name,
                 s.security AS security_status,
                 r.regionName AS region_name,
                 it.typeName AS ship_type,
-                km.time AS kill_time
+                strftime('%Y-%m-%dT%H:%M:%SZ', kf.time_epoch, 'unixepoch') AS kill_time
             FROM
-                killmails km
-            JOIN
-                solar_systems s ON km.solarSystemID = s.solarSystemID
+                kill_facts kf
             JOIN
-                regions r ON s.regionID = r.regionID
+                solar_systems s ON kf.solarSystemID = s.solarSystemID
             JOIN
-                invTypes it ON km.ship_type_id = it.typeID
+                regions r ON kf.regionID = r.regionID
             JOIN
-                invGroups ig ON it.groupID = ig.groupID
+                invTypes it ON kf.ship_type_id = it.typeID
             WHERE
-                km.time > ?
-                AND ig.groupID IN ({placeholders})
+                kf.time_epoch > ?
+                AND kf.groupID IN ({placeholders})
         """
         
-        if self.region_filter:
-            query += f"\n                AND LOWER(r.regionName) = ?"
+        region_ids = self.get_region_ids()
+        if region_ids:
+            query += f"\n                AND kf.regionID IN ({','.join('?' * len(region_ids))})"
         
         query += """
             ORDER BY
-                km.time DESC
+                kf.time_epoch DESC
         """
         return query
     
+    def query_params(self, past_date):
+        group_ids = self.get_group_ids()
+        region_ids = self.get_region_ids()
+        if not group_ids or region_ids == []:
+            return None
+        return tuple([past_date] + group_ids + (region_ids or []))
+    
     def get_data(self, past_date):
         query = self.build_query(past_date)
         if not query:
             print(f"Unknown ship group: {self.ship_filter}")
             return []
         
-        group_ids = self.get_group_ids()
-        if not group_ids:
+        params = self.query_params(past_date)
+        if params is None:
+            print(f"Unknown region: {self.region_filter}")
             return []
         
-        params = [past_date] + group_ids
-        if self.region_filter:
-            params.append(self.region_filter.lower())
-        
-        results = self.execute_query(query, tuple(params))
+        results = self.execute_query(query, params, since=past_date)
         if results:
             return [self._row_to_dict(row) for row in results]
         return []
@@ -9,6 +9,7 @@ from ZKillReports import Report
 class ShipsByGroup(Report):
     name = "ships_by_group"
     days_back = 2
+    reads_history = False
     
     GROUP_MAP = {
         'hauler': 28,
@@ -80,11 +81,12 @@ Examples:
             return [self.GROUP_MAP[filter_val]]
         
         # Try to find by groupName
-        query = "SELECT groupID FROM invGroups WHERE LOWER(groupName) = ?"
-        result = self.execute_query(query, (filter_val,))
-        if result:
-            return [result[0]['groupID']]
-        return None
+        return self.reference.group_ids_by_name(filter_val) or None
+    
+    def get_region_ids(self) -> list[int] | None:
+        if not self.region_filter:
+            return None
+        return self.reference.region_ids_by_name(self.region_filter)
     
     def build_query(self, past_date):
         group_ids = self.get_group_ids()
@@ -93,61 +95,52 @@ Examples:
         
         placeholders = ','.join('?' * len(group_ids))
         
+        region_filter = ""
+        region_ids = self.get_region_ids()
+        if region_ids:
+            region_filter = f"AND regionID IN ({','.join('?' * len(region_ids))})"
+        
+        # Summed on the hourly rollups, names are joined to the sums
         query = f"""
             SELECT
                 ig.groupName AS category,
                 it.typeName AS ship_type,
-                COUNT(*) AS total_kills
+                r.total_kills AS total_kills
             FROM
-                killmails km
+                (SELECT groupID, ship_type_id, SUM(kills) AS total_kills
+                 FROM kill_rollup_hourly
+                 WHERE hour > ? - 3600
+                   AND groupID IN ({placeholders})
+                   {region_filter}
+                 GROUP BY groupID, ship_type_id) r
             JOIN
-                invTypes it ON km.ship_type_id = it.typeID
+                invTypes it ON r.ship_type_id = it.typeID
             JOIN
-                invGroups ig ON it.groupID = ig.groupID
-            JOIN
-                solar_systems s ON km.solarSystemID = s.solarSystemID
-            JOIN
-                regions r ON s.regionID = r.regionID
-            WHERE
-                km.time > ?
-                AND ig.groupID IN ({placeholders})
-        """
-        
-        if self.region_filter:
-            query += f"\n                AND LOWER(r.regionName) = ?"
-        
-        query += """
-            GROUP BY
-                ig.groupName, it.typeName
+                invGroups ig ON r.groupID = ig.groupID
             ORDER BY
                 total_kills DESC
         """
         return query
     
+    def query_params(self, past_date):
+        group_ids = self.get_group_ids()
+        region_ids = self.get_region_ids()
+        if not group_ids or region_ids == []:
+            return None
+        return tuple([past_date] + group_ids + (region_ids or []))
+    
     def get_data(self, past_date):
         query = self.build_query(past_date)
         if not query:
             print(f"Unknown ship group: {self.group_filter}")
             return []
         
-        group_ids = self.get_group_ids()
-        if not group_ids:
+        params = self.query_params(past_date)
+        if params is None:
+            print(f"Unknown region: {self.region_filter}")
             return []
         
-        params = [past_date] + group_ids
-        if self.region_filter:
-            params.append(self.region_filter.lower())
-        
-        results = self.execute_query(query, tuple(params))
-        if results:
-            return [self._row_to_dict(row) for row in results]
-        return []
-        
-        group_ids = self.get_group_ids()
-        if not group_ids:
-            return []
-        params = (past_date,) + tuple(group_ids)
-        results = self.execute_query(query, params)
+        results = self.execute_query(query, params, since=past_date)
         if results:
             return [self._row_to_dict(row) for row in results]
         return []
@@ -6,20 +6,20 @@ from ZKillReports import Report
 class ShipsLost48Hours(Report):
     name = "ships_lost_48hours"
     days_back = 2
+    reads_history = False
     
     def build_query(self, past_date):
         return """
             SELECT
                 it.typeName AS ship_type,
-                COUNT(*) AS total_kills
+                SUM(r.total_kills) AS total_kills
             FROM
-                killmails km
+                (SELECT ship_type_id, SUM(kills) AS total_kills
+                 FROM kill_rollup_hourly
+                 WHERE hour > ? - 3600
+                 GROUP BY ship_type_id) r
             JOIN
-                solar_systems s ON km.solarSystemID = s.solarSystemID
-            JOIN
-                invTypes it ON km.ship_type_id = it.typeID
-            WHERE
-                km.time > ?
+                invTypes it ON r.ship_type_id = it.typeID
             GROUP BY
                 ship_type
             ORDER BY
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# rollups.py
+
+import sqlite3
+
+from collections import defaultdict
+
+from partitions import add_months, attach_partitions, month_bounds, month_of
+from utils import setup_logger, get_data_dir, load_config, create_database_connection, run_with_lock_retry, bump_data_generation
+
+# Hourly rollups of the kill history, kept in the main database and
+# updated by the consumer in the transaction that records each kill.
+# Reports over days or weeks read a few hundred rollup rows instead of
+# counting raw rows.  Rollups are not archived or pruned with the
+# partitions, so they also keep the totals of dropped months.
+
+HOUR = 3600
+
+UPSERT_KILL_ROLLUP = """
+    INSERT INTO kill_rollup_hourly (hour, solarSystemID, groupID, ship_type_id, regionID, kills, total_value)
+    VALUES (?, ?, ?, ?, ?, 1, ?)
+    ON CONFLICT (hour, solarSystemID, groupID, ship_type_id)
+    DO UPDATE SET kills = kills + 1, total_value = total_value + excluded.total_value
+"""
+
+UPSERT_ITEM_ROLLUP = """
+    INSERT INTO item_rollup_hourly (hour, typeID, quantity, quantity_destroyed, quantity_dropped)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (hour, typeID)
+    DO UPDATE SET quantity = quantity + excluded.quantity,
+                  quantity_destroyed = quantity_destroyed + excluded.quantity_destroyed,
+                  quantity_dropped = quantity_dropped + excluded.quantity_dropped
+"""
+
+
+def hour_of(epoch: int) -> int:
+    return epoch - epoch % HOUR
+
+
+def update_rollups(conn: sqlite3.Connection, fact, item_rows):
+    """
+    Add one recorded kill to the rollups.
+
+    fact: the kill's kill_facts row, see kill_facts.kill_fact_row
+    item_rows: its droppedItems rows, (typeID, flagID, quantity, killmail_id,
+               quantity_destroyed, quantity_dropped)
+
+    Does not commit, the caller owns the transaction.
+    """
+    (_, time_epoch, solar_system_id, region_id, _, ship_type_id, group_id, _, _, total_value) = fact
+    hour = hour_of(time_epoch)
+    conn.execute(UPSERT_KILL_ROLLUP, (hour, solar_system_id, group_id, ship_type_id, region_id, total_value or 0))
+
+    items = defaultdict(lambda: [0, 0, 0])
+    for type_id, _, quantity, _, quantity_destroyed, quantity_dropped in item_rows:
+        totals = items[type_id]
+        totals[0] += quantity
+        totals[1] += quantity_destroyed
+        totals[2] += quantity_dropped
+    if items:
+        conn.executemany(UPSERT_ITEM_ROLLUP, [(hour, type_id, *totals) for type_id, totals in items.items()])
+
+
+def rebuild_month(conn: sqlite3.Connection, month: str) -> tuple[int, int]:
+    """
+    Recompute the rollups of one month from kill_facts and droppedItems
+    in one transaction.  Returns the (kill, item) rollup rows written.
+
+    Reads the history through the usual table names, attach the
+    partitions first to include archived months.
+    """
+    start, end = month_bounds(month)
+    conn.execute("DELETE FROM main.kill_rollup_hourly WHERE hour >= ? AND hour < ?", (start, end))
+    conn.execute("DELETE FROM main.item_rollup_hourly WHERE hour >= ? AND hour < ?", (start, end))
+
+    kills = conn.execute(f"""
+        INSERT INTO main.kill_rollup_hourly (hour, solarSystemID, groupID, ship_type_id, regionID, kills, total_value)
+        SELECT time_epoch - time_epoch % {HOUR}, solarSystemID, groupID, ship_type_id, MAX(regionID),
+               COUNT(*), COALESCE(SUM(total_value), 0)
+        FROM kill_facts
+        WHERE time_epoch >= ? AND time_epoch < ?
+        GROUP BY 1, 2, 3, 4
+    """, (start, end)).rowcount
+
+    items = conn.execute(f"""
+        INSERT INTO main.item_rollup_hourly (hour, typeID, quantity, quantity_destroyed, quantity_dropped)
+        SELECT km.time_epoch - km.time_epoch % {HOUR}, di.typeID, SUM(di.quantity),
+               COALESCE(SUM(di.quantity_destroyed), 0), COALESCE(SUM(di.quantity_dropped), 0)
+        FROM killmails km
+        JOIN droppedItems di ON di.killmail_id = km.killmail_id
+        WHERE km.time_epoch >= ? AND km.time_epoch < ?
+        GROUP BY 1, 2
+    """, (start, end)).rowcount
+
+    bump_data_generation(conn)
+    conn.commit()
+    return kills, items
+
+
+def rebuild_rollups(conn: sqlite3.Connection, data_dir: str, config: dict, logger) -> int:
+    """
+    Regenerate every rollup from the kill history, archived months
+    included, one month per transaction so consumers keep writing.
+    Kills a consumer records meanwhile are added on top of the rebuilt
+    month, nothing is counted twice.  Months in partitions too old to be
+    attached keep the rollups they have.
+
+    Returns the number of months rebuilt.
+    """
+    attach_partitions(conn, data_dir, config, None, logger, truncate=True)
+    first, last = conn.execute("SELECT MIN(time_epoch), MAX(time_epoch) FROM kill_facts").fetchone()
+    if first is None:
+        return 0
+
+    month = month_of(first)
+    rebuilt = 0
+    while month <= month_of(last):
+        kills, items = run_with_lock_retry(rebuild_month, conn, month, config=config, logger=logger)
+        logger.info(f"Rebuilt rollups of {month}: {kills} kill rows, {items} item rows")
+        month = add_months(month, 1)
+        rebuilt += 1
+    return rebuilt
+
+
+# ==============================================
+# Rebuild, run after the rollup migration or to repair the rollups
+# ==============================================
+if __name__ == "__main__":
+    data_dir = str(get_data_dir()) + "/"
+    logger = setup_logger("rollups", log_file=data_dir + "zkill_db_init.log", console=True)
+    config = load_config(data_dir, logger)
+
+    conn = create_database_connection(data_dir + config["db_fname"], config)
+    try:
+        months = rebuild_rollups(conn, data_dir, config, logger)
+    finally:
+        conn.close()
+    logger.info(f"Rollup rebuild complete, {months} months")
@@ -0,0 +1,123 @@
+# seen_index.py
+
+import collections
+import sqlite3
+import time
+
+from pathlib import Path
+
+
+class SeenKillmails:
+    """
+    Index of the killIDs the pipeline has already handled, shared by the
+    producer and the consumers through one small SQLite file.
+
+    A killID is QUEUED once the producer has queued it and DONE once a
+    consumer has committed it.  The producer skips any killID it finds,
+    the consumer skips DONE ones, so a redelivered or twice queued
+    killmail never costs an ESI fetch.  Recently seen IDs are answered
+    from memory without touching the file.
+
+    DONE killIDs older than the retention are pruned, the killmails
+    table stays the last word on whether a killmail is stored.
+    """
+
+    QUEUED = 1
+    DONE = 2
+
+    def __init__(self, path: str | Path, recent_size: int = 100000, busy_timeout: int = 30000):
+        self.path = str(path)
+        self.recent_size = recent_size
+        self.recent = {}
+        self.recent_order = collections.deque()
+
+        self.conn = sqlite3.connect(self.path, timeout=busy_timeout / 1000.0, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = wal")
+        self.conn.execute("PRAGMA synchronous = normal")
+        self.conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen (
+                killmail_id INTEGER PRIMARY KEY,
+                state       INTEGER NOT NULL,
+                marked_at   INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(seen)")]
+        if "marked_at" not in columns:
+            # Files from before the retention, their killIDs count from now
+            self.conn.execute("ALTER TABLE seen ADD COLUMN marked_at INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE seen SET marked_at = ?", (int(time.time()),))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_state_marked ON seen (state, marked_at)")
+
+    def _remember(self, killID: int, state: int):
+        if killID not in self.recent:
+            self.recent_order.append(killID)
+            if len(self.recent_order) > self.recent_size:
+                self.recent.pop(self.recent_order.popleft(), None)
+        self.recent[killID] = max(state, self.recent.get(killID, 0))
+
+    def state(self, killID) -> int:
+        """QUEUED, DONE, or 0 for a killID never seen."""
+        killID = int(killID)
+        state = self.recent.get(killID)
+        if state == self.DONE:
+            return state
+
+        # A consumer may have finished a killID this process only saw queued
+        row = self.conn.execute("SELECT state FROM seen WHERE killmail_id = ?", (killID,)).fetchone()
+        if row is None:
+            return state or 0
+        self._remember(killID, row[0])
+        return row[0]
+
+    def is_seen(self, killID) -> bool:
+        if int(killID) in self.recent:
+            return True
+        return self.state(killID) != 0
+
+    def is_done(self, killID) -> bool:
+        return self.state(killID) == self.DONE
+
+    def _write(self, sql: str, killIDs: list[int]):
+        now = int(time.time())
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(sql, [(killID, now) for killID in killIDs])
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def mark_queued(self, killIDs):
+        """Record killIDs the producer queued, killIDs already DONE stay DONE."""
+        killIDs = [int(killID) for killID in killIDs]
+        self._write("INSERT OR IGNORE INTO seen (killmail_id, state, marked_at) VALUES (?, 1, ?)", killIDs)
+        for killID in killIDs:
+            self._remember(killID, self.QUEUED)
+
+    def mark_done(self, killIDs):
+        """Record killIDs a consumer committed."""
+        killIDs = [int(killID) for killID in killIDs]
+        self._write("INSERT OR REPLACE INTO seen (killmail_id, state, marked_at) VALUES (?, 2, ?)", killIDs)
+        for killID in killIDs:
+            self._remember(killID, self.DONE)
+
+    def prune(self, retention_days: float, batch_size: int = 10000) -> int:
+        """
+        Delete DONE killIDs marked more than retention_days ago, batch_size
+        per transaction so the producer is never held up.  Returns the
+        number deleted.
+        """
+        cutoff = int(time.time() - retention_days * 86400)
+        deleted = 0
+        while True:
+            count = self.conn.execute("""
+                DELETE FROM seen WHERE killmail_id IN (
+                    SELECT killmail_id FROM seen WHERE state = 2 AND marked_at < ? LIMIT ?)
+            """, (cutoff, batch_size)).rowcount
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    def close(self):
+        self.conn.close()
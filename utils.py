@@ -4,10 +4,15 @@ import logging
 import sys
 import os
 import json
+import queue
+import random
+import sqlite3
+import time
 
+from contextlib import contextmanager
 from datetime import datetime, timezone
-
 from pathlib import Path
+from urllib.request import pathname2url
 
 def setup_logger(
     name: str,
@@ -96,6 +101,14 @@ def get_data_dir(
     print("Please create one of these directories and ensure it contains required data.")
     sys.exit(1)
 
+def iso_to_epoch(iso_time: str) -> int:
+    """Epoch seconds of an ESI timestamp such as 2026-01-03T16:22:28Z."""
+    return int(datetime.fromisoformat(iso_time.replace("Z", "+00:00")).timestamp())
+
+def epoch_days_ago(days: float) -> int:
+    """Epoch seconds of the moment `days` days before now."""
+    return int(time.time() - days * 86400)
+
 def generate_timestamp() -> str:
     now = datetime.now(timezone.utc)
     sortable_timestamp = now.strftime("%Y-%m-%d-%H-%M-%S-%f")  # .%f gives microseconds
@@ -192,6 +205,28 @@ def claim_file_from_queue(directory: str | Path, consumer_id: str) -> Path | Non
     
     return None
 
+def release_file_to_queue(claimed_file: Path) -> Path | None:
+    """
+    Return a claimed file to the queue so it is retried later, by
+    renaming it back to its name before claim_file_from_queue.
+
+    Args:
+        claimed_file: Path returned by claim_file_from_queue
+
+    Returns:
+        Path of the file back in the queue, or None if it disappeared
+    """
+    name, sep, _ = claimed_file.name.rpartition('.processing-')
+    if not sep:
+        return claimed_file
+
+    released_file = claimed_file.with_name(name)
+    try:
+        claimed_file.rename(released_file)
+        return released_file
+    except FileNotFoundError:
+        return None
+
 def get_file_from_queue(directory: str | Path) -> Path | None:
     """
     Returns the alphabetically oldest file in the directory,
@@ -237,3 +272,169 @@ def load_config(data_dir, logger):
 
     return config
 
+# Defaults for the shared SQLite database, overridden by the "sqlite"
+# section of config.json
+SQLITE_DEFAULTS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "mmap_size": 268435456,     # 256 MB
+    "cache_size": -65536,       # negative is KiB, so 64 MB
+    "busy_timeout": 30000,      # milliseconds
+    "lock_retries": 5,
+    "lock_backoff": 0.2,        # seconds, doubled on every retry
+    "cached_statements": 256,   # prepared statements kept per read-only connection
+}
+
+def get_sqlite_settings(config: dict | None = None) -> dict:
+    """
+    Merge the "sqlite" section of config.json over SQLITE_DEFAULTS.
+
+    Example config.json section:
+
+        "sqlite": { "synchronous": "normal", "busy_timeout": 30000 }
+    """
+    settings = dict(SQLITE_DEFAULTS)
+    if config:
+        settings.update(config.get("sqlite", {}))
+    return settings
+
+def create_database_connection(db_path: str, config: dict | None = None) -> sqlite3.Connection:
+    """
+    Create and return a connection to the shared SQLite database.
+
+    Every component (consumers, webapp and reports) opens the database
+    through here so they all agree on WAL mode, where readers and the
+    writer no longer block each other.
+
+    Args:
+        db_path: Path to the database file
+        config: Loaded config.json, used for the "sqlite" settings
+
+    Returns:
+        Configured sqlite3.Connection
+    """
+    settings = get_sqlite_settings(config)
+
+    conn = sqlite3.connect(db_path, timeout=settings["busy_timeout"] / 1000.0)
+    conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+    run_with_lock_retry(conn.execute, f"PRAGMA journal_mode = {settings['journal_mode']}", config=config)
+    conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+    conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+    conn.execute("PRAGMA foreign_keys = ON")  # Enable foreign key constraints
+    return conn
+
+def create_readonly_connection(db_path: str, config: dict | None = None) -> sqlite3.Connection:
+    """
+    Open a read-only connection to the shared SQLite database, for the
+    webapp's connection pool.
+
+    The file is opened with mode=ro and query_only is set, so a stray
+    write fails instead of competing with the consumers for the write
+    lock.  The connection may be handed from thread to thread, as long
+    as one thread uses it at a time.
+    """
+    settings = get_sqlite_settings(config)
+
+    conn = sqlite3.connect(f"file:{pathname2url(str(Path(db_path).resolve()))}?mode=ro", uri=True,
+                           timeout=settings["busy_timeout"] / 1000.0, check_same_thread=False,
+                           cached_statements=int(settings["cached_statements"]))
+    conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+    conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+class ReadConnectionPool:
+    """
+    Read-only connections to one database, shared by the threads of a
+    process, so a request reuses an open connection and its prepared
+    statements instead of opening the file again.
+
+        with pool.connection() as conn:
+            conn.execute(...)
+
+    A borrow takes an idle connection or opens a new one, it never
+    waits.  Up to size idle connections are kept, extra ones are closed
+    when they come back.
+    """
+
+    def __init__(self, db_path: str, config: dict | None = None, size: int = 4):
+        self.db_path = db_path
+        self.config = config
+        self.size = max(1, int(size))
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = create_readonly_connection(self.db_path, self.config)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = None
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+def data_generation(conn: sqlite3.Connection) -> int | None:
+    """
+    The database's data generation, a counter bumped by every commit
+    that changes kill data, so readers can tell cached results are stale
+    with one primary key lookup.  None before the meta table exists.
+    """
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'data_generation'").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+def bump_data_generation(conn: sqlite3.Connection):
+    """Bump the data generation inside the write transaction it marks.  Does not commit."""
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_generation'")
+
+def is_lock_error(e: Exception) -> bool:
+    """True if the sqlite error is lock contention worth retrying."""
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+def run_with_lock_retry(func, *args, config: dict | None = None, logger=None, **kwargs):
+    """
+    Call func(*args, **kwargs), retrying with exponential backoff and
+    jitter while the database is locked by another process.
+
+    busy_timeout already waits inside SQLite, this covers the cases it
+    does not (a lock held past the timeout, or a busy snapshot in WAL mode).
+    Any other error, or the last lock error, is raised to the caller.
+    """
+    settings = get_sqlite_settings(config)
+    retries = int(settings["lock_retries"])
+    delay = float(settings["lock_backoff"])
+
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_lock_error(e) or attempt == retries:
+                raise
+            sleep_for = delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if logger:
+                logger.info(f"Database locked ({e}), retry {attempt + 1}/{retries} in {sleep_for:.2f}s")
+            time.sleep(sleep_for)
@@ -21,4 +21,8 @@ def create_app():
     from webapp import routes
     app.register_blueprint(routes.bp)
     
+    # Config, reference data and the read pool, loaded once for every request
+    from webapp.state import get_state
+    get_state()
+    
     return app
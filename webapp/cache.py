@@ -0,0 +1,71 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class QueryCache:
+    """
+    In-process cache of report results, keyed by the report and its
+    filters.
+
+    Entries expire after ttl seconds and the least recently used entry
+    is evicted beyond max_entries.  Every entry is dropped when the
+    database's data generation moves, which the consumers bump with each
+    commit.  Concurrent misses on one key run the query once, the other
+    requests wait for its result instead of all hitting the database.
+    """
+
+    def __init__(self, max_entries=256, ttl=30.0):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.generation = None
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, key, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+                return _MISSING
+            entry = self.entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return _MISSING
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation != self.generation:
+                return  # computed from data that has changed since
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, generation, compute):
+        value = self.get(key, generation)
+        if value is not _MISSING:
+            return value
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                value = self.get(key, generation)
+                if value is _MISSING:
+                    value = compute()
+                    self.put(key, generation, value)
+        finally:
+            with self.lock:
+                if self.key_locks.get(key) is key_lock:
+                    del self.key_locks[key]
+        return value
+
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 import sqlite3
 import signal
 import threading
@@ -10,23 +11,46 @@ sys.path.insert(0, BASE_DIR)
 sys.path.insert(0, os.path.join(BASE_DIR, 'reports'))
 
 from flask import Blueprint, render_template, request, jsonify, redirect, url_for
-from datetime import datetime, timedelta
+
+from partitions import PartitionRangeError
+from utils import data_generation
+from webapp.state import get_state
 
 bp = Blueprint('main', __name__)
 
-def get_db_path():
-    from utils import get_data_dir
-    data_dir_path = get_data_dir()
-    data_dir = str(data_dir_path) + "/"
-    from utils import load_config
-    import logging
-    logger = logging.getLogger('webapp')
-    config = load_config(data_dir, logger)
-    return data_dir + config["db_fname"]
+def cached(key, compute):
+    """Result of compute() from the query cache, computed again once the data generation moves."""
+    state = get_state()
+    if float(state.config.get("webapp_cache_ttl", 30)) <= 0:
+        return compute()
+    try:
+        with state.pool.connection() as conn:
+            generation = data_generation(conn)
+    except sqlite3.Error as e:
+        state.logger.error(f"Error reading data generation: {e}")
+        return compute()
+    return state.cache.get_or_compute(key, generation, compute)
+
+def report_data(report_class, filter_attribute, ship, days, region):
+    """Rows of a report with its filters, through the query cache."""
+    def compute():
+        report = report_class()
+        report.setup(shared=get_state())
+        setattr(report, filter_attribute, ship)
+        report.days_back = days
+        if region:
+            report.region_filter = region
+        return report.get_data(report.get_past_date())
+    return cached((report_class.__name__, ship, days, region), compute)
 
 def get_stats():
-    db_path = get_db_path()
-    past_date = (datetime.now() - timedelta(days=7)).isoformat()
+    return cached(("stats",), compute_stats)
+
+def compute_stats():
+    from utils import epoch_days_ago
+    state = get_state()
+    reference = state.reference
+    past_date = epoch_days_ago(7)
     
     stats = {
         'total_kills': 0,
@@ -36,50 +60,50 @@ def get_stats():
     }
     
     try:
-        with sqlite3.connect(db_path) as conn:
+        with state.pool.connection() as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
             
+            # Summed on the hourly rollups, whole hours back to past_date
+
             # Total kills
-            cursor.execute("SELECT COUNT(*) as cnt FROM killmails WHERE time > ?", (past_date,))
+            cursor.execute("SELECT COALESCE(SUM(kills), 0) as cnt FROM kill_rollup_hourly WHERE hour > ? - 3600", (past_date,))
             stats['total_kills'] = cursor.fetchone()['cnt']
             
             # Hauler kills
             cursor.execute("""
-                SELECT COUNT(*) as cnt FROM killmails km
-                JOIN invTypes it ON km.ship_type_id = it.typeID
-                JOIN invGroups ig ON it.groupID = ig.groupID
-                WHERE km.time > ? AND ig.groupID IN (28, 513, 902)
+                SELECT COALESCE(SUM(kills), 0) as cnt FROM kill_rollup_hourly
+                WHERE hour > ? - 3600 AND groupID IN (28, 513, 902)
             """, (past_date,))
             stats['hauler_kills'] = cursor.fetchone()['cnt']
             
             # Deadliest system
             cursor.execute("""
-                SELECT s.solarSystemName as name, COUNT(*) as cnt
-                FROM killmails km
-                JOIN solar_systems s ON km.solarSystemID = s.solarSystemID
-                WHERE km.time > ?
-                GROUP BY s.solarSystemName
+                SELECT solarSystemID as id, SUM(kills) as cnt
+                FROM kill_rollup_hourly
+                WHERE hour > ? - 3600
+                GROUP BY solarSystemID
                 ORDER BY cnt DESC
                 LIMIT 1
             """, (past_date,))
             row = cursor.fetchone()
             if row:
-                stats['deadliest_system'] = row['name']
+                system = reference.system(row['id'])
+                stats['deadliest_system'] = system.name if system else str(row['id'])
             
             # Top ship
             cursor.execute("""
-                SELECT it.typeName as name, COUNT(*) as cnt
-                FROM killmails km
-                JOIN invTypes it ON km.ship_type_id = it.typeID
-                WHERE km.time > ?
-                GROUP BY it.typeName
+                SELECT ship_type_id as id, SUM(kills) as cnt
+                FROM kill_rollup_hourly
+                WHERE hour > ? - 3600
+                GROUP BY ship_type_id
                 ORDER BY cnt DESC
                 LIMIT 1
             """, (past_date,))
             row = cursor.fetchone()
             if row:
-                stats['top_ship'] = row['name']
+                ship_type = reference.item_type(row['id'])
+                stats['top_ship'] = ship_type.name if ship_type else str(row['id'])
                 
     except Exception as e:
         print(f"Error getting stats: {e}")
@@ -98,15 +122,12 @@ def ships_by_group():
     region = request.args.get('region', '')
     
     from reports.ships_by_group import ShipsByGroup
-    report = ShipsByGroup()
-    report.setup()
-    report.group_filter = ship
-    report.days_back = days
-    if region:
-        report.region_filter = region
-    
-    data = report.get_data(report.get_past_date())
-    transformed = [report.transform_row(row) for row in data]
+    error = None
+    try:
+        data = report_data(ShipsByGroup, "group_filter", ship, days, region)
+    except PartitionRangeError as e:
+        data, error = [], str(e)
+    transformed = [ShipsByGroup().transform_row(row) for row in data]
     
     return render_template('report.html', 
                          report_name='Ships by Group',
@@ -114,6 +135,7 @@ def ships_by_group():
                          days=days,
                          region=region,
                          data=transformed,
+                         error=error,
                          columns=[('Category', 'category'), ('Ship Type', 'ship_type'), ('Kills', 'total_kills')])
 
 @bp.route('/ship_kills_by_system')
@@ -123,15 +145,12 @@ def ship_kills_by_system():
     region = request.args.get('region', '')
     
     from reports.ship_kills_by_system import ShipKillsBySystem
-    report = ShipKillsBySystem()
-    report.setup()
-    report.ship_filter = ship
-    report.days_back = days
-    if region:
-        report.region_filter = region
-    
-    data = report.get_data(report.get_past_date())
-    transformed = [report.transform_row(row) for row in data]
+    error = None
+    try:
+        data = report_data(ShipKillsBySystem, "ship_filter", ship, days, region)
+    except PartitionRangeError as e:
+        data, error = [], str(e)
+    transformed = [ShipKillsBySystem().transform_row(row) for row in data]
     
     return render_template('report.html',
                          report_name='Ship Kills by System',
@@ -139,6 +158,7 @@ def ship_kills_by_system():
                          days=days,
                          region=region,
                          data=transformed,
+                         error=error,
                          columns=[('System', 'system'), ('Sec', 'security'), ('Region', 'region'), ('Ship Type', 'ship_type'), ('Kill Time', 'kill_time')])
 
 @bp.route('/api/ships_by_group')
@@ -148,14 +168,11 @@ def api_ships_by_group():
     region = request.args.get('region', '')
     
     from reports.ships_by_group import ShipsByGroup
-    report = ShipsByGroup()
-    report.setup()
-    report.group_filter = ship
-    report.days_back = days
-    if region:
-        report.region_filter = region
-    
-    return jsonify(report.to_json())
+    try:
+        data = report_data(ShipsByGroup, "group_filter", ship, days, region)
+    except PartitionRangeError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(json.dumps(data, indent=2))
 
 @bp.route('/api/ship_kills_by_system')
 def api_ship_kills_by_system():
@@ -164,14 +181,11 @@ def api_ship_kills_by_system():
     region = request.args.get('region', '')
     
     from reports.ship_kills_by_system import ShipKillsBySystem
-    report = ShipKillsBySystem()
-    report.setup()
-    report.ship_filter = ship
-    report.days_back = days
-    if region:
-        report.region_filter = region
-    
-    return jsonify(report.to_json())
+    try:
+        data = report_data(ShipKillsBySystem, "ship_filter", ship, days, region)
+    except PartitionRangeError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(json.dumps(data, indent=2))
 
 @bp.route('/shutdown', methods=['POST'])
 def shutdown():
@@ -0,0 +1,34 @@
+import threading
+
+from reference_data import load_reference_data
+from utils import get_data_dir, load_config, setup_logger, ReadConnectionPool
+from webapp.cache import QueryCache
+
+
+class AppState:
+    """
+    What every request needs, loaded once per webapp process: config,
+    reference data, a pool of read-only connections and the query cache.
+    Reports set up with it borrow pooled connections, see Report.setup.
+    """
+
+    def __init__(self):
+        self.data_dir = str(get_data_dir()) + "/"
+        self.logger = setup_logger("webapp", log_file=self.data_dir + "zkill.log", console=True)
+        self.config = load_config(self.data_dir, self.logger)
+        self.db_path = self.data_dir + self.config["db_fname"]
+        self.reference = load_reference_data(self.data_dir, self.logger)
+        self.pool = ReadConnectionPool(self.db_path, self.config, self.config.get("webapp_pool_size", 4))
+        self.cache = QueryCache(self.config.get("webapp_cache_size", 256), self.config.get("webapp_cache_ttl", 30))
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state() -> AppState:
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = AppState()
+    return _state
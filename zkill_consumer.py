@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import csv
+import hashlib
 import json
 import os
 import sys
@@ -9,30 +10,42 @@ import requests
 import time
 import sqlite3
 
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from pathlib import Path
 
-from utils import setup_logger, get_data_dir, generate_timestamp, write_string_to_file, claim_file_from_queue, load_config
+from esi_client import EsiClient, EsiScheduler, is_permanent_error
+from kill_facts import backfill_kill_facts, insert_kill_facts, kill_fact_row
+from killmail_cache import KillmailCache
+from migrations import apply_migrations, schema_version
+from queue_backend import decode_payload, open_queue
+from reference_data import load_reference_data, load_reference_tables
+from rollups import rebuild_rollups, update_rollups
+from seen_index import SeenKillmails
+from utils import setup_logger, get_data_dir, generate_timestamp, write_string_to_file, load_config, create_database_connection, run_with_lock_retry, get_sqlite_settings, iso_to_epoch, bump_data_generation, is_lock_error
 
 # global variables
 config = {}
 
-items_dict = {}
-flags_dict = {}
-solar_systems_dict = {}
-regions_dict = {}
 regions_to_record = {}
-groups_dict = {}
-categories_dict = {}
 
-def create_database_connection(db_path: str) -> sqlite3.Connection:
-    """Create and return a connection to the SQLite database."""
-    try:
-        conn = sqlite3.connect(db_path)
-        conn.execute("PRAGMA foreign_keys = ON")  # Enable foreign key constraints
-        return conn
-    except sqlite3.Error as e:
-        logger.info(f"Error connecting to database: {e}")
-        raise
+# int-keyed reference records, see reference_data.ReferenceData
+reference = None
+
+# solarSystemIDs inside regions_to_record, precomputed from the reference data
+systems_to_record = set()
+
+# Running counters for the consumer, logged with log_stats()
+stats = Counter()
+
+# On-disk cache of raw killmails, None when disabled in config.json
+killmail_cache = None
+
+# Queue backend selected by config.json, see queue_backend.open_queue
+work_queue = None
+
+# killIDs already handled, shared with the producer
+seen_killmails = None
 
 def execute_sql_file(conn: sqlite3.Connection, sql_file: Path) -> bool:
     """Execute SQL commands from a file within a transaction."""
@@ -66,7 +79,7 @@ def validate_sql_file(sql_file: Path, logger) -> bool:
         logger.info("Warning: File extension is not .sql")
     return True
 
-def initialize_database(db_path: str, sql_file: str, logger) -> bool:
+def initialize_database(db_path: str, sql_file: str, logger, config: dict | None = None) -> bool:
     """Main function to initialize the database."""
     sql_path = Path(sql_file)
     
@@ -76,7 +89,7 @@ def initialize_database(db_path: str, sql_file: str, logger) -> bool:
     conn = None
     try:
         logger.info(f"Initializing database at {sql_file}")
-        conn = create_database_connection(db_path)
+        conn = create_database_connection(db_path, config)
         success = execute_sql_file(conn, sql_path)
         logger.info(f"Initialized successfully {success}")
         return success
@@ -84,194 +97,326 @@ def initialize_database(db_path: str, sql_file: str, logger) -> bool:
         if conn is not None:
             conn.close()
 
-def csv_to_dict(csv_file_path, id_is_which_column):
-    item_dict = {}
-    with open(csv_file_path, mode='r', encoding='utf-8') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        headers = next(csv_reader)  # Skip header row
-        for row in csv_reader:
-            item_id = row[id_is_which_column]  # First column = ID
-            item_dict[item_id] = row  # Store full row
-    return item_dict
-
-def csv_to_dict_try(csv_file_path, id_is_which_column, logger):
-    item_dict = {}
+# Reference CSVs loaded by init_database_only.  The header row of each
+# CSV names the table columns, typed tables get their numbers converted.
+REFERENCE_CSVS = [
+    ("invTypes.csv", "invTypes", False),
+    ("invFlags.csv", "invFlags", False),
+    ("mapRegions.csv", "regions", True),
+    ("mapSolarSystems.csv", "solar_systems", True),
+    ("invGroups.csv", "invGroups", False),
+    ("invCategories.csv", "invCategories", False),
+]
+
+# Columns of the typed tables that stay text
+TEXT_COLUMNS = {"regionName", "solarSystemName", "securityClass"}
+
+def csv_number(value):
+    """int or float of a CSV field, None for an empty or 'None' field."""
+    if not value or value == 'None':
+        return None
     try:
-        item_dict = csv_to_dict(csv_file_path, id_is_which_column)
-    except Exception as e:
-        logger.info(f"Unable to load {csv_file_path}")
-        pass
-    return item_dict
-        
-def batch_insert(conn, table, columns, data):
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def file_checksum(path) -> str:
+    """sha256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def table_primary_key(conn, table) -> str:
+    return next(row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[5] == 1)
+
+def bulk_load_csv(conn, csv_file_path, table, typed, logger, upsert=False):
     """
-    conn: SQLite connection
-    table: Table name (str)
-    columns: List of column names (list/tuple)
-    data: Sequence of parameter sequences
+    Stream one CSV straight into its table with a single executemany,
+    rows are converted as they are read and never held in memory.
+
+    With upsert, rows whose key is already loaded are updated in place,
+    and only when one of their columns changed.
+
+    Does not commit, the caller owns the transaction.
     """
-    placeholders = ', '.join(['?'] * len(columns))
-    columns_str = ', '.join(columns)
-    sql = f"INSERT INTO {table} ({columns_str}) VALUES ({placeholders})"
-    
-    cursor = conn.cursor()
+    with open(csv_file_path, mode='r', encoding='utf-8', newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        headers = next(csv_reader)  # Get column names
+        rows = (row for row in csv_reader if row)  # Skip blank lines
+        if typed:
+            converters = [str if header in TEXT_COLUMNS else csv_number for header in headers]
+            rows = (tuple(convert(value) for convert, value in zip(converters, row)) for row in rows)
+
+        placeholders = ', '.join(['?'] * len(headers))
+        sql = f"INSERT INTO {table} ({', '.join(headers)}) VALUES ({placeholders})"
+        if upsert:
+            key = table_primary_key(conn, table)
+            columns = [header for header in headers if header != key]
+            updates = ', '.join(f"{column} = excluded.{column}" for column in columns)
+            changed = ' OR '.join(f"{table}.{column} IS NOT excluded.{column}" for column in columns)
+            sql += f" ON CONFLICT ({key}) DO UPDATE SET {updates} WHERE {changed}"
+
+        before = conn.total_changes
+        conn.executemany(sql, rows)
+        changes = conn.total_changes - before
+
+    if upsert:
+        logger.info(f"Inserted or updated {changes} rows of {table}")
+    else:
+        logger.info(f"Inserted {changes} rows into {table}")
+    return changes
+
+def record_reference_file(conn, csv_name, checksum):
+    conn.execute("INSERT OR REPLACE INTO reference_files (fname, sha256, loaded_at) VALUES (?, ?, ?)",
+                 (csv_name, checksum, generate_timestamp()))
+
+def bulk_load_reference_data(conn, data_dir, logger, config=None):
+    """
+    Load every reference CSV in one transaction.
+
+    Foreign keys and syncs are off while loading, both are restored
+    before returning.
+    """
+    settings = get_sqlite_settings(config)
+    conn.execute("PRAGMA foreign_keys = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
     try:
-        cursor.executemany(sql, data)
+        conn.execute("BEGIN")
+        for csv_name, table, typed in REFERENCE_CSVS:
+            try:
+                checksum = file_checksum(data_dir + csv_name)
+                bulk_load_csv(conn, data_dir + csv_name, table, typed, logger)
+                record_reference_file(conn, csv_name, checksum)
+            except FileNotFoundError:
+                logger.info(f"Unable to load {data_dir + csv_name}")
         conn.commit()
-        return cursor.rowcount
-    except sqlite3.Error as e:
+    except Exception:
         conn.rollback()
-        raise e
+        raise
+    finally:
+        conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+        conn.execute("PRAGMA foreign_keys = ON")
 
-def load_invTypes(conn, logger):
-    logger.info("Inserting invTypes")
-    data = []
-
-    for row in items_dict.values():
-        typeID = row[0]
-        groupID = row[1]
-        typeName = row[2]
-        description = row[3]
-        mass = row[4]
-        volume = row[5]
-        capacity = row[6]
-        portionSize = row[7]
-        raceID = row[8]
-        basePrice = row[9]
-        published = row[10]
-        marketGroupID = row[11]
-        iconID = row[12]
-        soundID = row[13]
-        graphicID = row[14]
-        data.append((typeID, groupID, typeName, description, mass, volume, capacity, portionSize, raceID, basePrice, published, marketGroupID, iconID, soundID, graphicID))
-
-    batch_insert(conn, 'invTypes', ['typeID', 'groupID', 'typeName', 'description', 'mass', 'volume', 'capacity', 'portionSize', 'raceID', 'basePrice', 'published', 'marketGroupID', 'iconID', 'soundID', 'graphicID'], data)
- 
-def load_invFlags(conn, logger):
-    logger.info("Inserting invFlags")
-    data = []
-
-    for row in flags_dict.values():
-        flagID = row[0]
-        flagName = row[1]
-        flagText = row[2]
-        orderID = row[3]
-        data.append((flagID, flagName, flagText, orderID))
-
-    batch_insert(conn, 'invFlags', ['flagID', 'flagName', 'flagText', 'orderID'], data)
- 
-def load_regions(conn, logger):
-    logger.info("Inserting invRegions")
-    data = []
-
-    for row in regions_dict.values():
-        regionID = row[0]
-        regionName = row[1]
-        x = float(row[2]) if row[2] and row[2] != 'None' else None
-        y = float(row[3]) if row[3] and row[3] != 'None' else None
-        z = float(row[4]) if row[4] and row[4] != 'None' else None
-        xMin = float(row[5]) if row[5] and row[5] != 'None' else None
-        xMax = float(row[6]) if row[6] and row[6] != 'None' else None
-        yMin = float(row[7]) if row[7] and row[7] != 'None' else None
-        yMax = float(row[8]) if row[8] and row[8] != 'None' else None
-        zMin = float(row[9]) if row[9] and row[9] != 'None' else None
-        zMax = float(row[10]) if row[10] and row[10] != 'None' else None
-        factionID = int(row[11]) if row[11] and row[11] != 'None' else None
-        nebula = int(row[12]) if row[12] and row[12] != 'None' else None
-        radius = float(row[13]) if row[13] and row[13] != 'None' else None
-        data.append((regionID, regionName, x, y, z, xMin, xMax, yMin, yMax, zMin, zMax, factionID, nebula, radius))
-
-    batch_insert(conn, 'regions', ['regionID', 'regionName', 'x', 'y', 'z', 'xMin', 'xMax', 'yMin', 'yMax', 'zMin', 'zMax', 'factionID', 'nebula', 'radius'], data)
- 
-def load_solar_systems(conn, logger):
-    logger.info("Inserting inv_solar_systems")
-    data = []
-
-    for row in solar_systems_dict.values():
-        solarSystemID = int(row[2]) if row[2] and row[2] != 'None' else None
-        regionID = int(row[0]) if row[0] and row[0] != 'None' else None
-        constellationID = int(row[1]) if row[1] and row[1] != 'None' else None
-        solarSystemName = row[3]
-        x = float(row[4]) if row[4] and row[4] != 'None' else None
-        y = float(row[5]) if row[5] and row[5] != 'None' else None
-        z = float(row[6]) if row[6] and row[6] != 'None' else None
-        xMin = float(row[7]) if row[7] and row[7] != 'None' else None
-        xMax = float(row[8]) if row[8] and row[8] != 'None' else None
-        yMin = float(row[9]) if row[9] and row[9] != 'None' else None
-        yMax = float(row[10]) if row[10] and row[10] != 'None' else None
-        zMin = float(row[11]) if row[11] and row[11] != 'None' else None
-        zMax = float(row[12]) if row[12] and row[12] != 'None' else None
-        luminosity = float(row[13]) if row[13] and row[13] != 'None' else None
-        border = int(row[14]) if row[14] and row[14] != 'None' else None
-        fringe = int(row[15]) if row[15] and row[15] != 'None' else None
-        corridor = int(row[16]) if row[16] and row[16] != 'None' else None
-        hub = int(row[17]) if row[17] and row[17] != 'None' else None
-        international = int(row[18]) if row[18] and row[18] != 'None' else None
-        regional = int(row[19]) if row[19] and row[19] != 'None' else None
-        constellation = int(row[20]) if row[20] and row[20] != 'None' else None
-        security = float(row[21]) if row[21] and row[21] != 'None' else None
-        factionID = int(row[22]) if row[22] and row[22] != 'None' else None
-        radius = float(row[23]) if row[23] and row[23] != 'None' else None
-        sunTypeID = int(row[24]) if row[24] and row[24] != 'None' else None
-        securityClass = row[25]
-        data.append((solarSystemID, regionID, constellationID, solarSystemName, x, y, z, xMin, xMax, yMin, yMax, zMin, zMax, luminosity, border, fringe, corridor, hub, international, regional, constellation, security, factionID, radius, sunTypeID, securityClass))
-
-    batch_insert(conn, 'solar_systems', ['solarSystemID', 'regionID', 'constellationID', 'solarSystemName', 'x', 'y', 'z', 'xMin', 'xMax', 'yMin', 'yMax', 'zMin', 'zMax', 'luminosity', 'border', 'fringe', 'corridor', 'hub', 'international', 'regional', 'constellation', 'security', 'factionID', 'radius', 'sunTypeID', 'securityClass'], data)
-
-def load_invGroups(conn, logger, data_dir):
-    logger.info("Inserting invGroups")
-    csv_file_path = data_dir + 'invGroups.csv'
-    data = []
-    with open(csv_file_path, mode='r', encoding='utf-8') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        headers = next(csv_reader)  # Get column names
-        for row in csv_reader:
-            data.append(tuple(row))
-    batch_insert(conn, 'invGroups', headers, data)
-
-def load_invCategories(conn, logger, data_dir):
-    logger.info("Inserting invCategories")
-    csv_file_path = data_dir + 'invCategories.csv'
-    data = []
-    with open(csv_file_path, mode='r', encoding='utf-8') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        headers = next(csv_reader)  # Get column names
-        for row in csv_reader:
-            data.append(tuple(row))
-    batch_insert(conn, 'invCategories', headers, data)
+def refresh_reference_tables(conn, data_dir, logger) -> int:
+    """
+    Upsert the reference CSVs that changed since they were last loaded,
+    all in one transaction.  A CSV whose checksum matches the one in
+    reference_files is skipped.  Rows missing from a new CSV are kept,
+    killmails may still reference them.
+
+    Returns the number of rows inserted or updated.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reference_files (
+            fname     TEXT PRIMARY KEY,
+            sha256    TEXT NOT NULL,
+            loaded_at TEXT
+        )
+    """)
+    loaded = dict(conn.execute("SELECT fname, sha256 FROM reference_files"))
+
+    changes = 0
+    try:
+        conn.execute("BEGIN")
+        for csv_name, table, typed in REFERENCE_CSVS:
+            try:
+                checksum = file_checksum(data_dir + csv_name)
+            except FileNotFoundError:
+                logger.info(f"Unable to load {data_dir + csv_name}")
+                continue
+            if loaded.get(csv_name) == checksum:
+                logger.info(f"{csv_name} unchanged - skipping")
+                continue
+            changes += bulk_load_csv(conn, data_dir + csv_name, table, typed, logger, upsert=True)
+            record_reference_file(conn, csv_name, checksum)
+        run_with_lock_retry(conn.commit, logger=logger)
+    except Exception:
+        conn.rollback()
+        raise
+    return changes
+
+def insert_droppedItems(conn, rows):
+    """
+    Insert all droppedItems rows for a killmail with a single executemany.
+
+    rows: Sequence of (typeID, flagID, quantity, killmail_id, quantity_destroyed, quantity_dropped) tuples
+
+    Does not commit, the caller owns the transaction.
+    """
+    sql = ("INSERT INTO droppedItems (typeID, flagID, quantity, killmail_id, quantity_destroyed, quantity_dropped) "
+           "VALUES (?,?,?,?,?,?)")
 
-def insert_droppedItem(conn, typeID, flagID, quantity, killmail_id):
-    sql = f"INSERT INTO droppedItems (typeID, flagID, quantity, killmail_id) VALUES (?,?,?,?)"
-    
     cursor = conn.cursor()
     try:
-        cursor.execute(sql, [typeID, flagID, quantity, killmail_id])
-        conn.commit()
+        cursor.executemany(sql, rows)
         return cursor.rowcount
     except sqlite3.Error as e:
-        conn.rollback()
         logger.info(f"ERROR E1 {e}")
         raise e
 
+def insert_victim(conn, killmail_id, victim):
+    """Does not commit, the caller owns the transaction."""
+    position = victim.get("position") or {}
+    conn.execute(
+        "INSERT OR IGNORE INTO victims (killmail_id, character_id, corporation_id, alliance_id, faction_id, "
+        "ship_type_id, damage_taken, x, y, z) VALUES (?,?,?,?,?,?,?,?,?,?)",
+        (killmail_id, victim.get("character_id"), victim.get("corporation_id"), victim.get("alliance_id"),
+         victim.get("faction_id"), victim.get("ship_type_id"), victim.get("damage_taken"),
+         position.get("x"), position.get("y"), position.get("z")))
+
+def insert_attackers(conn, killmail_id, attackers):
+    """
+    Insert every attacker of a killmail with a single executemany.
+
+    Does not commit, the caller owns the transaction.
+    """
+    rows = [(killmail_id, attacker.get("character_id"), attacker.get("corporation_id"), attacker.get("alliance_id"),
+             attacker.get("faction_id"), attacker.get("ship_type_id"), attacker.get("weapon_type_id"),
+             attacker.get("damage_done", 0), int(bool(attacker.get("final_blow"))))
+            for attacker in attackers]
+    conn.executemany(
+        "INSERT INTO attackers (killmail_id, character_id, corporation_id, alliance_id, faction_id, "
+        "ship_type_id, weapon_type_id, damage_done, final_blow) VALUES (?,?,?,?,?,?,?,?,?)", rows)
+
+def insert_kill_value(conn, killmail_id, zkb):
+    """Does not commit, the caller owns the transaction."""
+    flags = [None if zkb.get(key) is None else int(bool(zkb[key])) for key in ("npc", "solo", "awox")]
+    conn.execute(
+        "INSERT OR IGNORE INTO kill_values (killmail_id, total_value, fitted_value, destroyed_value, dropped_value, "
+        "points, npc, solo, awox) VALUES (?,?,?,?,?,?,?,?,?)",
+        (killmail_id, zkb.get("totalValue"), zkb.get("fittedValue"), zkb.get("destroyedValue"),
+         zkb.get("droppedValue"), zkb.get("points"), *flags))
+
 def insert_killmail(conn, killmail_id, xtime, solarSystemID, ship_type_id):
-    sql = f"INSERT INTO killmails (killmail_id, time, solarSystemID, ship_type_id) VALUES (?,?,?,?)"
-   
+    """
+    Insert the killmail row, returns 0 if the killmail is already recorded.
+
+    Does not commit, the caller owns the transaction.
+    """
+    sql = "INSERT OR IGNORE INTO killmails (killmail_id, time, time_epoch, solarSystemID, ship_type_id) VALUES (?,?,?,?,?)"
+
     cursor = conn.cursor()
     try:
-        cursor.execute(sql, [killmail_id, xtime, solarSystemID, ship_type_id])
-        conn.commit()
+        cursor.execute(sql, [killmail_id, xtime, iso_to_epoch(xtime), solarSystemID, ship_type_id])
         return cursor.rowcount
     except sqlite3.Error as e:
-        conn.rollback()
         logger.info(f"ERROR X {e}")
-        return 0
+        raise e
+
+class CommitBatcher:
+    """
+    Groups the writes of several killmails into one commit.
+
+    Fetched killmails wait in memory until max_kills of them are pending
+    or the oldest is older than max_seconds.  flush() then writes them all
+    in one transaction, so the write lock is only held while writing,
+    never while fetches are outstanding.  With max_kills = 1 every
+    killmail is committed on its own.  Queue items are only acked after
+    the commit that made their killmail durable.
+    """
 
-    logger.info("Unexpected Error")
-    return 0
+    def __init__(self, conn, work_queue, max_kills=1, max_seconds=5.0, seen=None):
+        self.conn = conn
+        self.work_queue = work_queue
+        self.seen = seen
+        self.max_kills = max(1, int(max_kills))
+        self.max_seconds = float(max_seconds)
+        self.pending_items = []
+        self.pending_data = []
+        self.first_pending = None
+
+    def add(self, item, data):
+        """Hold a fetched killmail for the next flush."""
+        if self.first_pending is None:
+            self.first_pending = time.monotonic()
+        self.pending_items.append(item)
+        self.pending_data.append(data)
+
+    def due(self) -> bool:
+        if not self.pending_items:
+            return False
+        if len(self.pending_items) >= self.max_kills:
+            return True
+        return time.monotonic() - self.first_pending >= self.max_seconds
+
+    def write(self) -> dict:
+        """
+        Insert every pending killmail in one transaction and commit it.
+        Returns {index: error} of the killmails that failed, their
+        savepoints were rolled back and the rest is committed.  A lock
+        error undoes the whole batch, for run_with_lock_retry to retry.
+        """
+        failed = {}
+        changes = self.conn.total_changes
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for index, (item, data) in enumerate(zip(self.pending_items, self.pending_data)):
+                try:
+                    insert_zkill(self.conn, data, item.zkb)
+                except Exception as e:
+                    if is_lock_error(e):
+                        raise
+                    failed[index] = e
+            if self.conn.total_changes != changes:
+                # Readers caching results see the new generation with the data
+                bump_data_generation(self.conn)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return failed
+
+    def flush(self):
+        if not self.pending_items:
+            return
+        failed = run_with_lock_retry(self.write, config=config, logger=logger)
+
+        written = []
+        for index, item in enumerate(self.pending_items):
+            if index in failed:
+                logger.info(f"Unexpected error: 002 {failed[index]}")
+                fail_queued_item(item, f"Unexpected error: {failed[index]}")
+            else:
+                written.append(item)
+        if self.seen is not None:
+            self.seen.mark_done([item.killID for item in written if item.killID is not None])
+        for item in written:
+            self.work_queue.ack(item)
+            logger.info(f"DELETED  ******** {item}")
+        logger.info(f"Committed {len(written)} killmails")
+        self.pending_items = []
+        self.pending_data = []
+        self.first_pending = None
+
+# Schema versions whose migrations create tables derived from history
+KILL_FACTS_VERSION = 3
+ROLLUPS_VERSION = 5
+
+def backfill_derived_tables(conn, data_dir, config, logger, from_version):
+    """
+    Fill the derived tables that the migrations since from_version
+    created empty on a database that already holds killmails, so the
+    reports never read them before the history is in: kill_facts first,
+    the rollups are rebuilt from it.
+    """
+    if from_version >= ROLLUPS_VERSION:
+        return
+    if conn.execute("SELECT 1 FROM killmails LIMIT 1").fetchone() is None:
+        return
+
+    if from_version < KILL_FACTS_VERSION:
+        logger.info("Backfilling kill_facts from the recorded killmails")
+        written = backfill_kill_facts(conn, load_reference_data(data_dir, logger), logger, config)
+        logger.info(f"kill_facts backfill complete, {written} rows written")
+    logger.info("Rebuilding the rollups from the recorded killmails")
+    months = rebuild_rollups(conn, data_dir, config, logger)
+    logger.info(f"Rollup rebuild complete, {months} months")
 
 def init_database_only():
     """Initialize database with tables and reference data if needed"""
-    global items_dict, flags_dict, solar_systems_dict, regions_dict, groups_dict, categories_dict
     
     data_dir_path = get_data_dir()
     data_dir = str(data_dir_path) + "/"
@@ -282,18 +427,30 @@ def init_database_only():
     config = load_config(data_dir, logger)
     
     logger.info("Starting database initialization...")
+
+    # Compile the lookup tables the consumers load, even when the database exists
+    load_reference_tables(data_dir, logger)
     
     db_fname = data_dir + config["db_fname"]
     
     if os.path.exists(db_fname):
         logger.info("Database already exists, checking initialization...")
         try:
-            conn = create_database_connection(str(db_fname))
+            conn = create_database_connection(str(db_fname), config)
             cursor = conn.cursor()
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='killmails'")
             if cursor.fetchone():
-                logger.info("Database is already initialized")
-                conn.close()
+                logger.info("Database is already initialized, refreshing reference data")
+                try:
+                    refresh_reference_tables(conn, data_dir, logger)
+                    from_version = schema_version(conn)
+                    apply_migrations(conn, logger)
+                    backfill_derived_tables(conn, data_dir, config, logger, from_version)
+                except Exception as e:
+                    logger.error(f"Database upgrade failed: {e}")
+                    sys.exit(1)
+                finally:
+                    conn.close()
                 return
             else:
                 logger.info("Database exists but tables missing, reinitializing...")
@@ -305,32 +462,35 @@ def init_database_only():
     try:
         sql_file = "ZKillQuery_setup.sql"
         
-        if initialize_database(db_fname, sql_file, logger):
+        if initialize_database(db_fname, sql_file, logger, config):
             logger.info("Database schema created successfully!")
         else:
             logger.error("Failed to create database schema")
             sys.exit(1)
         
-        conn = create_database_connection(db_fname)
+        conn = create_database_connection(db_fname, config)
         
         # Load reference data
         logger.info("Loading reference data...")
+        start = time.monotonic()
+        try:
+            bulk_load_reference_data(conn, data_dir, logger, config)
+        finally:
+            conn.close()
+        logger.info(f"Reference data loaded in {time.monotonic() - start:.1f}s")
         
-        items_dict = csv_to_dict_try(data_dir + 'invTypes.csv', 0, logger)
-        flags_dict = csv_to_dict_try(data_dir + 'invFlags.csv', 0, logger)
-        solar_systems_dict = csv_to_dict_try(data_dir + 'mapSolarSystems.csv', 2, logger)
-        regions_dict = csv_to_dict_try(data_dir + 'mapRegions.csv', 0, logger)
-        groups_dict = csv_to_dict_try(data_dir + 'invGroups.csv', 0, logger)
-        categories_dict = csv_to_dict_try(data_dir + 'invCategories.csv', 0, logger)
-        
-        load_invTypes(conn, logger)
-        load_invFlags(conn, logger)
-        load_regions(conn, logger)
-        load_solar_systems(conn, logger)
-        load_invGroups(conn, logger, data_dir)
-        load_invCategories(conn, logger, data_dir)
+        # Indexes are built once the data is in, faster than updating them per row
+        if initialize_database(db_fname, "ZKillQuery_indexes.sql", logger, config):
+            logger.info("Database indexes created successfully!")
+        else:
+            logger.error("Failed to create database indexes")
+            sys.exit(1)
         
-        conn.close()
+        conn = create_database_connection(db_fname, config)
+        try:
+            apply_migrations(conn, logger)
+        finally:
+            conn.close()
         
         logger.info("Database initialization completed successfully!")
         
@@ -338,20 +498,192 @@ def init_database_only():
         logger.error(f"Database initialization failed: {e}")
         sys.exit(1)
 
-def insert_zkill(conn, data):
+def refresh_reference_data():
+    """Apply new Fuzzwork CSVs to an initialized database, see refresh_reference_tables"""
+    data_dir_path = get_data_dir()
+    data_dir = str(data_dir_path) + "/"
+
+    log_file = data_dir + "zkill_db_init.log"
+    logger = setup_logger("zkill_db_refresh", log_file=log_file, console=True)
+
+    config = load_config(data_dir, logger)
+
+    # Consumers pick the new lookup file up when they restart
+    load_reference_tables(data_dir, logger)
+
+    db_fname = data_dir + config["db_fname"]
+    start = time.monotonic()
+    conn = create_database_connection(db_fname, config)
+    try:
+        changes = refresh_reference_tables(conn, data_dir, logger)
+    finally:
+        conn.close()
+    logger.info(f"Reference data refreshed, {changes} rows changed in {time.monotonic() - start:.1f}s")
+
+def build_systems_to_record():
+    """Precompute the set of solarSystemIDs that lie in regions_to_record."""
+    return reference.systems_in_regions(regions_to_record)
+
+def package_solar_system_id(package) -> int | None:
+    """
+    Find the solar system of a RedisQ package without going to ESI.
+
+    Uses the inline killmail when RedisQ sent one, otherwise the zkb
+    metadata.  Returns None when the package does not say.
+    """
+    killmail = package.get("killmail")
+    if isinstance(killmail, dict) and "solar_system_id" in killmail:
+        return int(killmail["solar_system_id"])
+
+    zkb = package.get("zkb") or {}
+    for key in ("solarSystemID", "solar_system_id", "systemID"):
+        if key in zkb:
+            return int(zkb[key])
+
+    # locationID is only a solar system inside the solar system ID range,
+    # otherwise it is the nearest celestial
+    location_id = zkb.get("locationID")
+    if location_id and 30000000 <= int(location_id) < 33000000:
+        return int(location_id)
+
+    return None
+
+def package_in_regions(package) -> bool:
+    """
+    Decide from the RedisQ package alone if the killmail can be in one
+    of the regions we record.  Packages that do not say where the kill
+    happened are kept, insert_zkill makes the final decision.
+    """
+    solar_system_id = package_solar_system_id(package)
+    if solar_system_id is None:
+        stats["prefilter_unknown"] += 1
+        return True
+    return solar_system_id in systems_to_record
+
+def inline_killmail(package) -> dict | None:
+    """
+    Return the killmail RedisQ embedded in the package, or None when it
+    is missing or lacks a field insert_zkill needs, so ESI is used.
+    """
+    killmail = package.get("killmail")
+    if not isinstance(killmail, dict):
+        return None
+
+    try:
+        if int(killmail["killmail_id"]) != int(package["killID"]):
+            return None
+        killmail["killmail_time"]
+        killmail["solar_system_id"]
+        killmail["victim"]["ship_type_id"]
+        # ESI leaves items out when the victim had none
+        if not isinstance(killmail["victim"].get("items", []), list):
+            return None
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    return killmail
+
+def discard_queued_item(item):
+    work_queue.ack(item)
+
+def dead_letter_item(item, reason):
+    stats["dead_letter"] += 1
+    logger.info(f"Dead letter {item}: {reason}")
+    work_queue.dead_letter(item, reason)
+
+def fail_queued_item(item, reason):
+    """Count a failed attempt, the queue retries it or dead-letters it after queue_max_retries."""
+    if work_queue.fail(item, reason):
+        stats["dead_letter"] += 1
+        logger.info(f"Dead letter {item} after too many attempts: {reason}")
+    else:
+        stats["retry"] += 1
+
+def killmail_recorded(conn, killID) -> bool:
+    """Primary key lookup, the last word on whether a killmail is already stored."""
+    cursor = conn.execute("SELECT 1 FROM killmails WHERE killmail_id = ?", (int(killID),))
+    return cursor.fetchone() is not None
+
+def start_killmail_fetch(item, esi, batch_ids) -> Future | None:
+    """
+    Read a claimed queue item and start getting its killmail.
+
+    Returns a Future resolving to the killmail dict: already done for an
+    inline killmail, otherwise running on the EsiClient pool.  Returns
+    None, after removing the item, when the package is skipped.
+    batch_ids collects the killIDs started in this claim batch.
+    """
+    data = decode_payload(item.payload)
+
+    try:
+        killID = data['package']['killID']
+        kill_hash = data['package']['zkb']['hash']
+    except Exception as e:
+        logger.info(f"Missing key in data: {e} - Skipping...")
+        discard_queued_item(item)
+        return None
+
+    stats["packages"] += 1
+    if stats["packages"] % 100 == 0:
+        log_stats()
+
+    if killID in batch_ids or seen_killmails.is_done(killID) or killmail_recorded(conn, killID):
+        stats["duplicate"] += 1
+        logger.info(f"Duplicate {killID} already handled, no ESI fetch")
+        discard_queued_item(item)
+        return None
+    batch_ids.add(killID)
+    item.killID = killID
+    item.zkb = data['package']['zkb']
+
+    if not package_in_regions(data['package']):
+        stats["filtered_by_region"] += 1
+        logger.info(f"Filtered {killID} outside regions of interest, no ESI fetch")
+        discard_queued_item(item)
+        return None
+
+    killmail = inline_killmail(data['package'])
+    if killmail is not None:
+        stats["inline_killmail"] += 1
+        logger.info(f"Using inline killmail for {killID}")
+        if esi.cache is not None:
+            esi.cache.put(killID, kill_hash, killmail)
+        future = Future()
+        future.set_result(killmail)
+        return future
+
+    stats["esi_fetch"] += 1
+    return esi.submit(killID, kill_hash)
+
+def log_stats():
+    if killmail_cache is not None:
+        stats["cache_hits"] = killmail_cache.hits
+        stats["cache_misses"] = killmail_cache.misses
+    counts = ', '.join(f"{key}={value}" for key, value in sorted(stats.items()))
+    logger.info(f"Stats: {counts}")
+
+def insert_zkill(conn, data, zkb=None):
     try:
         killmail_id = data["killmail_id"]
         killmail_time = data["killmail_time"]
-        solar_system_id = str(data["solar_system_id"])
-        ship_type_id    = str(data["victim"]["ship_type_id"])
+        solar_system_id = int(data["solar_system_id"])
+        ship_type_id    = int(data["victim"]["ship_type_id"])
+
+        items_list      = data["victim"].get("items", [])
 
-        items_list      = data["victim"]["items"]
+        solar_system = reference.system(solar_system_id)
+        ship_type    = reference.item_type(ship_type_id)
+        if solar_system is None:
+            raise KeyError(solar_system_id)
+        if ship_type is None:
+            raise KeyError(ship_type_id)
 
-        solar_system_name = solar_systems_dict[str(solar_system_id)][3]
-        region            = str(solar_systems_dict[str(solar_system_id)][0])
-        region_name       = regions_dict[region][1]
+        solar_system_name = solar_system.name
+        region            = solar_system.region_id
+        region_record     = reference.region(region)
+        region_name       = region_record.name if region_record else str(region)
 
-        ship_type_name    = items_dict[str(ship_type_id)][2]
+        ship_type_name    = ship_type.name
 
         message = ship_type_name + " Killed in " + solar_system_name + "/" + region_name
         logger.info(message)
@@ -364,30 +696,54 @@ def insert_zkill(conn, data):
             logger.info(f"Recording {region}")
             logger.info("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
 
-        ret = insert_killmail(conn, int(killmail_id), str(killmail_time), int(solar_system_id), int(ship_type_id))
-        logger.info(f"RET :{ret}:")
+        # One savepoint per killmail, so a failing killmail does not undo
+        # the other killmails of the CommitBatcher's transaction
+        conn.execute("SAVEPOINT killmail")
+        try:
+            ret = insert_killmail(conn, int(killmail_id), str(killmail_time), solar_system_id, ship_type_id)
+            logger.info(f"RET :{ret}:")
 
-        if ret == 0:
-            logger.info(f"Not Recorded {region}")
-            return
+            if ret == 0:
+                logger.info(f"Not Recorded {region}")
+                conn.execute("RELEASE SAVEPOINT killmail")
+                return
 
-        for item in items_list:
-            item_type_id = item["item_type_id"]
-            flag_id = item["flag"]
+            rows = []
+            for item in items_list:
+                item_type_id = item["item_type_id"]
+                flag_id = item["flag"]
 
-            try:
-                x = items_dict[str(item_type_id)]
-                item_name    = items_dict[str(item_type_id)][2]
-                quantity     = 0
-                if 'quantity_destroyed' in item:
-                    quantity = item["quantity_destroyed"]
-                else:
-                    quantity = item["quantity_dropped"]
-
-                count = insert_droppedItem(conn, item_type_id, flag_id, quantity, killmail_id)
-            except KeyError as e:
-                logger.info(f"Unable to find Key: {e}")
-                pass
+                try:
+                    if reference.item_type(item_type_id) is None:
+                        raise KeyError(item_type_id)
+                    quantity_destroyed = item.get("quantity_destroyed", 0)
+                    quantity_dropped   = item.get("quantity_dropped", 0)
+                    quantity           = quantity_destroyed + quantity_dropped
+
+                    rows.append((item_type_id, flag_id, quantity, killmail_id, quantity_destroyed, quantity_dropped))
+                except KeyError as e:
+                    logger.info(f"Unable to find Key: {e}")
+                    pass
+
+            if rows:
+                insert_droppedItems(conn, rows)
+
+            insert_victim(conn, killmail_id, data["victim"])
+            insert_attackers(conn, killmail_id, data.get("attackers") or [])
+            if zkb:
+                insert_kill_value(conn, killmail_id, zkb)
+
+            fact = kill_fact_row(reference, int(killmail_id), iso_to_epoch(killmail_time), solar_system_id,
+                                 ship_type_id, sum(row[2] for row in rows), (zkb or {}).get("totalValue"))
+            if fact:
+                insert_kill_facts(conn, [fact])
+                update_rollups(conn, fact, rows)
+
+            conn.execute("RELEASE SAVEPOINT killmail")
+        except Exception:
+            conn.execute("ROLLBACK TO SAVEPOINT killmail")
+            conn.execute("RELEASE SAVEPOINT killmail")
+            raise
 
     except json.JSONDecodeError as e:
         logger.info(f"Invalid JSON: {e}")
@@ -425,82 +781,153 @@ if __name__ == "__main__":
     logger.info(f"DB Fname: {config['db_fname']}")
 
     for iRegion in config["regions"]:
-        regions_to_record[str(iRegion)] = 1
+        regions_to_record[int(iRegion)] = 1
+
+    work_queue = open_queue(config, data_dir)
+    logger.info(f"Queue backend: {config.get('queue_backend', 'directory')}")
 
-    queue_dir = data_dir + "queue/"
+    # Load the compiled reference data, zkill_db_init normally compiled it already
+    reference = load_reference_data(data_dir, logger)
 
-    # Load reference data for processing
-    items_dict = csv_to_dict_try(data_dir + 'invTypes.csv',0,logger)
-    flags_dict = csv_to_dict_try(data_dir + 'invFlags.csv',0,logger)
-    solar_systems_dict = csv_to_dict_try(data_dir + 'mapSolarSystems.csv',2,logger)
-    regions_dict = csv_to_dict_try(data_dir + 'mapRegions.csv',0,logger)
-    groups_dict = csv_to_dict_try(data_dir + 'invGroups.csv',0,logger)
-    categories_dict = csv_to_dict_try(data_dir + 'invCategories.csv',0,logger)
+    systems_to_record = build_systems_to_record()
+    logger.info(f"Solar systems in regions of interest: {len(systems_to_record)}")
 
     # Database should be initialized by zkill_db_init service
     db_fname = data_dir + config["db_fname"]
     logger.info(f"Connecting to database: {db_fname}")
     
-    conn = create_database_connection(db_fname)
+    conn = create_database_connection(db_fname, config)
     logger.info("Database connected successfully")
 
+    # commit_batch_size = 1 keeps one commit per killmail
+    commit_batch_size = int(config.get("commit_batch_size", 1))
+    commit_batch_seconds = float(config.get("commit_batch_seconds", 5))
+    logger.info(f"Commit batch: {commit_batch_size} killmails / {commit_batch_seconds} seconds")
+    seen_killmails = SeenKillmails(data_dir + config.get("seen_fname", "seen_killmails.db"))
+    batcher = CommitBatcher(conn, work_queue, commit_batch_size, commit_batch_seconds, seen_killmails)
+
     container_index = os.getenv('CONTAINER_INDEX', '1')
     hostname = os.getenv('HOSTNAME', 'unknown')
     # Generate unique consumer ID from container index and hostname
     consumer_id = f"zkill_consumer_{container_index}"
     
+    esi_concurrency = int(config.get("esi_concurrency", 8))
+    claim_batch_size = int(config.get("claim_batch_size", esi_concurrency))
+    logger.info(f"ESI concurrency: {esi_concurrency}, claim batch: {claim_batch_size}")
+    scheduler = EsiScheduler(
+        min_interval=float(config.get("esi_min_interval", 0.0)),
+        error_limit_floor=int(config.get("esi_error_limit_floor", 20)),
+        max_backoff=float(config.get("esi_max_backoff", 300)),
+        logger=logger)
+    killmail_cache_fname = config.get("killmail_cache_fname", "killmail_cache.db")
+    if killmail_cache_fname:
+        killmail_cache_max_mb = int(config.get("killmail_cache_max_mb", 2048))
+        logger.info(f"Killmail cache: {killmail_cache_fname} ({killmail_cache_max_mb} MB)")
+        killmail_cache = KillmailCache(data_dir + killmail_cache_fname, killmail_cache_max_mb * 1024 * 1024, logger)
+    esi = EsiClient(concurrency=esi_concurrency, timeout=30, logger=logger, scheduler=scheduler, cache=killmail_cache)
+
     # Add small random delay to stagger consumer startups
     import random
     import time
     time.sleep(random.uniform(0.5, 2.0))
+    # Renew leases well before they expire, look for stale ones from
+    # dead consumers a few times per lease
+    lease_seconds = float(config.get("queue_lease_seconds", 300))
+    heartbeat_seconds = lease_seconds / 3
+    last_reclaim = 0.0
+    # DONE killIDs are pruned from the seen index once an hour
+    seen_retention_days = float(config.get("seen_retention_days", 30))
+    last_seen_prune = 0.0
+
     while True:
         try:
+            if batcher.due():
+                batcher.flush()
+
+            if seen_retention_days > 0 and time.monotonic() - last_seen_prune >= 3600:
+                last_seen_prune = time.monotonic()
+                pruned = seen_killmails.prune(seen_retention_days)
+                if pruned:
+                    logger.info(f"Pruned {pruned} killIDs older than {seen_retention_days:g} days from the seen index")
+
+            if time.monotonic() - last_reclaim >= heartbeat_seconds:
+                last_reclaim = time.monotonic()
+                reclaimed = work_queue.reclaim_stale()
+                if reclaimed:
+                    stats["reclaimed"] += reclaimed
+                    logger.info(f"Reclaimed {reclaimed} items with expired leases")
+
             logger.info(f"Consumer {consumer_id} checking queue")
 
-            oldest_queued = None
-            oldest_queued = claim_file_from_queue(queue_dir, consumer_id)
-            if oldest_queued:
-                logger.info(f"Consumer {consumer_id} claimed {oldest_queued}")
+            claimed = work_queue.claim(consumer_id, claim_batch_size)
+            if not claimed:
+                # Never sit on uncommitted killmails while idle
+                batcher.flush()
+                log_stats()
+                logger.info("Queue is empty, sleeping ...")
+                time.sleep(10)
+                continue
 
-                data =  json.loads(oldest_queued.read_text())
+            logger.info(f"Consumer {consumer_id} claimed {len(claimed)} items")
 
+            # Fetch stage: every claimed item is started at once, ESI
+            # fetches run concurrently on the EsiClient pool
+            pending = {}
+            batch_ids = set()
+            for item in claimed:
                 try:
-                    killID = data['package']['killID']
-                    kill_hash = data['package']['zkb']['hash']
-                except Exception as e:
-                    logger.info(f"Missing key in data: {e} - Skipping...")
-                    oldest_queued.unlink()
+                    future = start_killmail_fetch(item, esi, batch_ids)
+                except ValueError as e:
+                    logger.info(f"Payload decode error: {e} - Skipping...")
+                    dead_letter_item(item, f"Payload decode error: {e}")
                     continue
+                except Exception as e:  # Catch-all for unexpected issues
+                    logger.info(f"Unexpected error: 002 {e}")
+                    fail_queued_item(item, f"Unexpected error: {e}")
+                    continue
+                if future is not None:
+                    pending[future] = item
+
+            # Write stage: this thread is the only writer, killmails are
+            # inserted in the order their fetches complete.  Leases of the
+            # items still fetching are renewed while waiting, and the wait
+            # wakes up in time to commit a batch at commit_batch_seconds.
+            not_done = set(pending)
+            last_touch = time.monotonic()
+            while not_done:
+                done, not_done = wait(not_done, timeout=min(heartbeat_seconds, max(batcher.max_seconds, 0.1)),
+                                      return_when=FIRST_COMPLETED)
+                if not_done and time.monotonic() - last_touch >= heartbeat_seconds:
+                    last_touch = time.monotonic()
+                    work_queue.touch([pending[future] for future in not_done])
+
+                for future in done:
+                    item = pending[future]
+                    try:
+                        batcher.add(item, future.result())
+                    except requests.exceptions.RequestException as e:
+                        if is_permanent_error(e):
+                            stats["esi_rejected"] += 1
+                            logger.info(f"ESI rejected {item}: {e} - Skipping...")
+                            discard_queued_item(item)
+                        else:
+                            # Rate limits, 5xx and timeouts say nothing about the
+                            # kill: keep it without counting an attempt, the
+                            # EsiScheduler paces the retry
+                            stats["esi_retry"] += 1
+                            logger.info(f"Network error: {e} - Requeued {item}")
+                            work_queue.release(item)
+                    except json.JSONDecodeError as e:
+                        logger.info(f"JSON decode error: {e} - Skipping...")
+                        dead_letter_item(item, f"JSON decode error: {e}")
+                    except Exception as e:  # Catch-all for unexpected issues
+                        logger.info(f"Unexpected error: 002 {e}")
+                        fail_queued_item(item, f"Unexpected error: {e}")
+
+                if batcher.due():
+                    batcher.flush()
 
-                url_template = "https://esi.evetech.net/latest/killmails/{zkillID}/{hash}/"
-                url = url_template.format(zkillID=killID, hash=kill_hash)
-                logger.info(f"Killmail info for url {killID} {kill_hash} {url}")
-
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
-
-                data = response.json ()
-                insert_zkill(conn, data)
-
-                oldest_queued.unlink()
-                logger.info(f"DELETED  ******** {oldest_queued}")
-            else:
-                logger.info("Queue is empty, sleeping ...")
-                time.sleep(10)
-
-        except requests.exceptions.RequestException as e:
-            logger.info(f"Network error: {e} - Retrying in 10 seconds...")
-            if oldest_queued and oldest_queued.exists():
-                oldest_queued.unlink()
-            time.sleep(10)  # Backoff to avoid hammering the API
-        except json.JSONDecodeError as e:
-            logger.info(f"JSON decode error: {e} - Skipping...")
-            if oldest_queued and oldest_queued.exists():
-                oldest_queued.unlink()
-            continue
         except Exception as e:  # Catch-all for unexpected issues
-            logger.info(f"Unexpected error: 002 {e}")
-            if oldest_queued and oldest_queued.exists():
-                oldest_queued.unlink()
+            logger.info(f"Unexpected error: 003 {e}")
+            time.sleep(1)
             continue
-
@@ -2,7 +2,9 @@
 
 import json
 import os
+import queue
 import sys
+import threading
 
 import requests
 import time
@@ -10,11 +12,157 @@ import time
 from pathlib import Path
 from typing import Optional
 
-from utils import setup_logger, get_data_dir, generate_timestamp, write_string_to_file, load_config
+from requests.adapters import HTTPAdapter
+
+from queue_backend import QUEUE_FORMATS, compact_package, encode_payload, open_queue
+from seen_index import SeenKillmails
+from utils import setup_logger, get_data_dir, load_config
 
 # global variables
 config = {}
 
+
+class RedisQListener:
+    """
+    Long-polls one RedisQ queue over a persistent keep-alive session.
+
+    Tracks how long each poll takes and how many polls come back with
+    an empty package.
+    """
+
+    LISTEN_URL = "https://zkillredisq.stream/listen.php"
+
+    def __init__(self, queue_name: str, logger, timeout: float = 180):
+        self.queue_name = queue_name
+        self.logger = logger
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        self.polls = 0
+        self.empty_polls = 0
+        self.poll_seconds = 0.0
+        self.max_poll_seconds = 0.0
+
+    def poll(self) -> dict | None:
+        """Wait for the next package, returns None for an empty poll."""
+        start = time.monotonic()
+        response = self.session.get(self.LISTEN_URL, params={"queueID": self.queue_name}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        elapsed = time.monotonic() - start
+        self.polls += 1
+        self.poll_seconds += elapsed
+        self.max_poll_seconds = max(self.max_poll_seconds, elapsed)
+
+        if data.get("package") is None:
+            self.empty_polls += 1
+            return None
+        return data
+
+    def log_stats(self):
+        if not self.polls:
+            return
+        self.logger.info(
+            f"RedisQ {self.queue_name}: {self.polls} polls, "
+            f"{100.0 * self.empty_polls / self.polls:.1f}% empty, "
+            f"latency avg {self.poll_seconds / self.polls:.2f}s max {self.max_poll_seconds:.2f}s")
+
+
+class QueueWriter(threading.Thread):
+    """
+    Writes encoded packages to the queue backend on its own thread, so
+    the listener can start its next long-poll while the last package is
+    still being written.  Packages waiting in the buffer are written as
+    one batch.
+
+    Every listener feeds the same writer, which drops any killID the
+    SeenKillmails index already knows, so packages RedisQ redelivers, or
+    delivers on more than one queue, are only queued once.
+    """
+
+    def __init__(self, config: dict, data_dir: str, buffer: queue.Queue, logger, batch_size: int = 100):
+        super().__init__(name="queue_writer", daemon=True)
+        self.config = config
+        self.data_dir = data_dir
+        self.buffer = buffer
+        self.logger = logger
+        self.batch_size = batch_size
+        self.suffix = QUEUE_FORMATS[config.get("queue_format", "json")]
+        self.duplicates = 0
+
+    def run(self):
+        # The queue is opened here, a SQLite connection stays on its thread
+        work_queue = open_queue(self.config, self.data_dir)
+        seen = SeenKillmails(self.data_dir + self.config.get("seen_fname", "seen_killmails.db"))
+
+        while True:
+            batch = [self.buffer.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+
+            unique = []
+            batch_ids = set()
+            for killID, payload in batch:
+                if killID in batch_ids or seen.is_seen(killID):
+                    self.duplicates += 1
+                    self.logger.info(f"Duplicate killID {killID} - skipping ({self.duplicates} so far)")
+                    continue
+                batch_ids.add(killID)
+                unique.append((killID, payload))
+            batch = unique
+            if not batch:
+                continue
+
+            while True:
+                try:
+                    queued = work_queue.put_many([payload for _, payload in batch], self.suffix)
+                    break
+                except Exception as e:  # Keep the packages and try again
+                    self.logger.info(f"Error writing to queue: {e} - Retrying in 1 second...")
+                    time.sleep(1)
+
+            seen.mark_queued(batch_ids)
+
+            for (killID, payload), name in zip(batch, queued):
+                self.logger.info(f"Queued killID {killID} as {name} ({len(payload)} bytes)")
+
+
+def run_listener(listener: RedisQListener, buffer: queue.Queue, queue_format: str, logger):
+    """Sit in a loop and accept notifications from one RedisQ queue."""
+    while True:
+        try:
+            data = listener.poll()
+            if listener.polls % 100 == 0:
+                listener.log_stats()
+
+            if data is None:
+                logger.info(f"Received null package on {listener.queue_name} - skipping ...")
+                continue
+
+            try:
+                compact = compact_package(data)
+            except (KeyError, TypeError) as e:
+                logger.info(f"Package missing key {e} - skipping ...")
+                continue
+
+            buffer.put((compact['package']['killID'], encode_payload(compact, queue_format)))
+        except requests.exceptions.RequestException as e:
+            logger.info(f"Network error on {listener.queue_name}: {e} - Retrying in 10 seconds...")
+            time.sleep(10)  # Backoff to avoid hammering the API
+        except json.JSONDecodeError as e:
+            logger.info(f"JSON decode error: {e} - Skipping...")
+            continue
+        except Exception as e:  # Catch-all for unexpected issues
+            logger.info(f"Unexpected error on {listener.queue_name}: {e}")
+            raise  # Re-raise to exit if critical, or handle as needed
+
+
 # ==============================================
 # Main program execution starts here
 # ==============================================
@@ -24,7 +172,7 @@ if __name__ == "__main__":
         os.nice(10)  # Add 10 to nice value (lower priority)
     except PermissionError:
         pass  # Continue if we don't have permission to change priority
-    
+
     data_dir_path = get_data_dir()
     data_dir = str(data_dir_path) + "/"
 
@@ -33,40 +181,39 @@ if __name__ == "__main__":
 
     config = load_config(data_dir, logger)
 
-    queue_dir = data_dir + "queue/"
     try:
-        Path(queue_dir).mkdir(parents=True, exist_ok=True)
+        open_queue(config, data_dir).close()
     except Exception as e:  # Catch-all for unexpected issues
-        logger.info(f"Unexpected exception creating directory, {e}")
+        logger.info(f"Unexpected exception opening queue, {e}")
         sys.exit(1)
+    logger.info(f"Queue backend: {config.get('queue_backend', 'directory')}")
 
-    # Sit in a loop and accept notifications from Zkillmails RedisQ
+    queue_format = config.get("queue_format", "json")
+    if queue_format not in QUEUE_FORMATS:
+        logger.info(f"Unknown queue_format {queue_format}")
+        sys.exit(1)
+    logger.info(f"Queue format: {queue_format}")
 
-    while True:
-        try:
-            logger.info("Waiting on Listener")
-            response = requests.get("https://zkillredisq.stream/listen.php?queueID=" + config["redis_queue_name"], stream=True, timeout=180)
-            logger.info("Response from Listener")
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get("package") is None:
-                logger.info("Received null package - skipping ...")
-                continue
+    # Packages handed from the listener to the writer thread
+    buffer = queue.Queue(maxsize=int(config.get("producer_buffer_size", 1000)))
+    writer = QueueWriter(config, data_dir, buffer, logger)
+    writer.start()
 
-            pretty_json = json.dumps(data, indent=4)
-            logger.info(pretty_json)
+    # Several RedisQ queues can be drained in parallel, one listener each
+    queue_names = config.get("redis_queue_names") or [config["redis_queue_name"]]
+    logger.info(f"Redis Queues: {', '.join(queue_names)}")
 
-            filename = queue_dir + generate_timestamp() + ".json"
-            logger.info(filename)
-            write_string_to_file(filename, pretty_json)
-        except requests.exceptions.RequestException as e:
-            logger.info(f"Network error: {e} - Retrying in 10 seconds...")
-            time.sleep(10)  # Backoff to avoid hammering the API
-        except json.JSONDecodeError as e:
-            logger.info(f"JSON decode error: {e} - Skipping...")
-            continue
-        except Exception as e:  # Catch-all for unexpected issues
-            logger.info(f"Unexpected error: {e}")
-            raise  # Re-raise to exit if critical, or handle as needed
+    listeners = []
+    for queue_name in queue_names:
+        listener = RedisQListener(queue_name, logger)
+        thread = threading.Thread(target=run_listener, args=(listener, buffer, queue_format, logger),
+                                  name=f"listener_{queue_name}", daemon=True)
+        thread.start()
+        listeners.append(thread)
+
+    # Exit when a listener or the writer dies, the container restarts us
+    while all(thread.is_alive() for thread in listeners) and writer.is_alive():
+        time.sleep(5)
 
+    logger.info("A producer thread exited - shutting down")
+    sys.exit(1)